@@ -0,0 +1,44 @@
+"""
+Loader for dynamics models exported with learn.models.export.export_model. Only needs torch (and numpy for the
+NumPy interface), so controllers on board or in hardware in the loop processes start quickly.
+"""
+import json
+
+import numpy as np
+import torch
+
+
+class InferenceModel:
+    """
+    Wraps an exported graph with the predict / predict_torch interface of the dynamics models, so it can be handed
+    to MPController or ModelEnv in place of the trained model.
+    """
+
+    def __init__(self, filepath, device='cpu'):
+        extra = {'meta.json': ''}
+        self.net = torch.jit.load(filepath, map_location=device, _extra_files=extra)
+        self.net.eval()
+        meta = json.loads(extra['meta.json'])
+        self.E = meta['E']
+        self.dx, self.du, self.dt = meta['dx'], meta['du'], meta['dt']
+        self.state_list = meta['state_list']
+        self.input_list = meta['input_list']
+        self.change_state_list = meta['change_state_list']
+
+    def get_training_lists(self):
+        return self.state_list, self.input_list, self.change_state_list
+
+    def predict_torch(self, X, U):
+        # [N x dx], [N x du] tensors to the [N x dt] mean predicted change in state
+        return self.net(X, U)
+
+    def predict(self, X, U):
+        l = np.shape(X)[0] if len(np.shape(X)) > 1 else 1
+        X = torch.as_tensor(np.asarray(X, dtype=np.float32).reshape(l, -1))
+        U = torch.as_tensor(np.asarray(U, dtype=np.float32).reshape(l, -1))
+        with torch.no_grad():
+            return self.net(X, U).numpy().squeeze()
+
+
+def load_inference(filepath, device='cpu'):
+    return InferenceModel(filepath, device=device)
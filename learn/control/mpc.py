@@ -1,10 +1,13 @@
 from .controller import Controller
+import time
 import torch
 
 
 class MPController(Controller):
     def __init__(self, env, model, controller_cfg):
         super(MPController, self).__init__(controller_cfg)
+        # mpc is random shooting, cem and mppi are the iterative planners, each with its own config section
+        self.planner = controller_cfg.policy.mode
         controller_cfg = controller_cfg[controller_cfg.policy.mode]
         self.env = env
         self.model = model
@@ -13,78 +16,277 @@ class MPController(Controller):
         self.T = self.cfg.params.T
         self.hold = self.cfg.params.hold
 
-        self.yaw = controller_cfg.params.mode
+        # receding horizon: keep the best plan, shift it each tick and only re-optimize every replan ticks
+        self.replan = self.cfg.params.get('replan', 1)
+        self.warm_start = self.cfg.params.get('warm_start', False)
+        self.plan = None
+
+        # anytime mode: with a deadline (seconds) > 0, candidates are evaluated in chunks until the deadline and the
+        #   best found so far is used. evaluated reports how many candidates the last plan actually looked at
+        self.deadline = self.cfg.params.get('deadline', 0)
+        self.chunk = self.cfg.params.get('chunk', self.N)
+        self.rollout_cost = None
+        self.candidate_cost = None
+        self.evaluated = 0
+
+        # how random shooting samples: random (uniform), yaw (discrete yaw actions per step) or primitives (whole
+        #   sequences from the params.primitives library)
+        self.sample_mode = controller_cfg.params.mode
+        self.yaw = self.sample_mode == 'yaw'
 
         self.low = torch.tensor(self.env.action_space.low, dtype=torch.float32)
         self.high = torch.tensor(self.env.action_space.high, dtype=torch.float32)
         self.action_sampler = torch.distributions.Uniform(low=self.low, high=self.high)
 
+        if self.planner == 'cem':
+            self.iterations = self.cfg.params.iterations
+            self.elites = self.cfg.params.elites
+            # the gaussian is refit to the elites, which needs at least two of them and no more than the candidates
+            if not 2 <= self.elites <= self.N:
+                raise ValueError(f"CEM needs 2 <= elites <= N, got elites {self.elites} with N {self.N}")
+            self.alpha = self.cfg.params.alpha
+        elif self.planner == 'mppi':
+            self.iterations = self.cfg.params.iterations
+            self.temperature = self.cfg.params.temperature
+            self.std = self.cfg.params.std
+        elif self.planner != 'mpc':
+            raise ValueError(f"Planner Not Supported {self.planner}")
+
         self.yaw_actions = torch.tensor([
             [1500, 1500, 1500, 1500],
             [2000, 1000, 1000, 2000],
             [1000, 2000, 2000, 1000],
             [2000, 2000, 1000, 1000],
             [1000, 1000, 2000, 2000],
-        ])
+        ], dtype=torch.float32)
+
+        if self.sample_mode == 'primitives':
+            self.primitives = self.load_primitives(self.cfg.params.primitives)
+
+    def load_primitives(self, primitives):
+        """
+        Builds the [P x T x du] library of motion primitives from the config, a list of action sequences. Sequences
+        shorter than the horizon hold their last action, longer ones are cut at T.
+        """
+        library = torch.zeros((len(primitives), self.T, len(self.low)))
+        for i, seq in enumerate(primitives):
+            seq = torch.tensor([list(a) for a in seq], dtype=torch.float32)[:self.T]
+            library[i, :len(seq)] = seq
+            library[i, len(seq):] = seq[-1]
+        return library
+
     def reset(self):
-        self.interal = 0
-        print("Resetting MPController Not Needed, but passed")
+        self.internal = 0
+        self.plan = None
         return
 
     def get_action(self, state, metric=None):
-        # if self.internal % self.update_period == 0:
-        # repeat the state
-        state0 = torch.tensor(state).repeat(self.N, 1)
-        states = torch.zeros(self.N, self.T + 1, state.shape[-1])
-        states[:, 0, :] = state0
-        rewards = torch.zeros(self.N, self.T)
-        if self.yaw:
+        if self.plan is not None and self.internal % self.replan != 0:
+            # between replans, step along the stored plan
+            self.plan = self.shift_plan(self.plan)
+        else:
+            init = self.shift_plan(self.plan) if (self.warm_start and self.plan is not None) else None
+            self.start = time.perf_counter()
+            self.evaluated = 0
+            if self.planner == 'cem':
+                self.plan = self.cem(state, metric=metric, init=init)
+            elif self.planner == 'mppi':
+                self.plan = self.mppi(state, metric=metric, init=init)
+            else:
+                self.plan = self.random_shooting(state, metric=metric, init=init)
+        best_action = self.plan[0]
+
+        self.last_action = best_action
+        self.internal += 1
+        return best_action
+
+    def shift_plan(self, plan):
+        # drop the executed action and repeat the last one to keep a T step plan
+        return torch.cat((plan[1:], plan[-1:]), dim=0)
+
+    def random_shooting(self, state, metric=None, init=None):
+        """
+        Samples N action sequences uniformly from the action space and returns the best one. If init is given (the
+        shifted previous plan) it replaces one of the candidates, so the plan is only changed if something better is found.
+        In primitives mode each primitive is a candidate once (at most N of them) and init is scored alongside them.
+        """
+        if self.deadline > 0:
+            return self.anytime_shooting(state, metric=metric, init=init)
+
+        action_candidates = self.sample_candidates(self.N)
+        if init is not None:
+            if self.sample_mode == 'primitives':
+                action_candidates = torch.cat((init.unsqueeze(0), action_candidates), dim=0)
+            else:
+                action_candidates[0] = init
+
+        cumulative_reward = self.rollout(state, action_candidates, metric=metric)
+
+        best = torch.argmax(cumulative_reward)
+        return action_candidates[best, :, :]
+
+    def anytime_shooting(self, state, metric=None, init=None):
+        """
+        Random shooting bounded by the wall clock. Candidates are evaluated in chunks, up to N in total, and the
+        loop stops once the remaining time could not fit another chunk. A chunk is costed as a fixed per rollout
+        overhead (T sequential model calls) plus a cost per candidate, both measured as it runs and raised as soon as
+        a slower call is seen, so the deadline holds when the machine is loaded. In primitives mode the library is
+        walked in a random order and the loop also stops once every primitive has been scored.
+        """
+        # primitives are taken from one shuffled copy of the library so none is evaluated twice
+        library = self.sample_candidates(len(self.primitives)) if self.sample_mode == 'primitives' else None
+        taken = 0
+
+        def draw(n):
+            nonlocal taken
+            if library is None:
+                return self.sample_candidates(n)
+            taken += n
+            return library[taken - n:taken]
 
-            action_idx = torch.randint(0,5,(self.N, self.T),dtype=torch.long)
-            action_candidates = torch.zeros((self.N, self.T,len(self.low)))
-            for i in range(action_candidates.shape[0]):
-                act = []
-                for t in range(self.T):
-                    act.append(self.yaw_actions[action_idx[i,t]])
-                action_candidates[i,:,:] = torch.stack(act)
+        # always evaluate one sequence (the warm start if there is one), this also measures the rollout overhead
+        best_seq = init if init is not None else draw(1)[0]
+        t0 = time.perf_counter()
+        best_reward = self.rollout(state, best_seq.unsqueeze(0), metric=metric)[0]
+        self.update_cost(1, time.perf_counter() - t0)
+
+        while self.evaluated < self.N:
+            remaining = self.deadline - (time.perf_counter() - self.start)
+            n = min(self.chunk, self.N - self.evaluated,
+                    int((remaining - self.rollout_cost) / self.candidate_cost))
+            if library is not None:
+                n = min(n, len(library) - taken)
+            if n < 1:
+                break
+
+            t0 = time.perf_counter()
+            action_candidates = draw(n)
+            cumulative_reward = self.rollout(state, action_candidates, metric=metric)
+            self.update_cost(n, time.perf_counter() - t0)
+
+            best = torch.argmax(cumulative_reward)
+            if cumulative_reward[best] > best_reward:
+                best_reward = cumulative_reward[best]
+                best_seq = action_candidates[best, :, :]
+
+        return best_seq
+
+    def update_cost(self, n, elapsed):
+        # running estimates of the rollout overhead and the cost per extra candidate, they follow slow downs at once
+        #   and recover gradually
+        def track(old, measured):
+            return measured if old is None else max(measured, .9 * old + .1 * measured)
+
+        if n == 1:
+            if self.rollout_cost is not None and elapsed > self.rollout_cost:
+                # the machine got slower since the last chunk was measured, scale the candidate cost with it
+                self.candidate_cost *= elapsed / self.rollout_cost
+            self.rollout_cost = track(self.rollout_cost, elapsed)
+            if self.candidate_cost is None:
+                # first guess, a full chunk costs about two rollouts. Corrected by the first chunk measured
+                self.candidate_cost = elapsed / self.chunk
+        else:
+            marginal = max(elapsed - self.rollout_cost, 0) / (n - 1)
+            self.candidate_cost = max(track(self.candidate_cost, marginal), 1e-9)
+
+    def sample_candidates(self, n):
+        # samples n candidate action sequences, [n x T x du], according to the sampling mode. Primitives are drawn
+        #   without replacement, so there are at most as many candidates as primitives
+        if self.yaw:
+            action_idx = torch.randint(0, len(self.yaw_actions), (n, self.T), dtype=torch.long)
+            action_candidates = self.yaw_actions[action_idx]
+        elif self.sample_mode == 'primitives':
+            primitive_idx = torch.randperm(len(self.primitives))[:n]
+            action_candidates = self.primitives[primitive_idx]
         else:
             if self.hold:
-                action_candidates = self.action_sampler.sample(sample_shape=(self.N, 1)).repeat(1, self.T, 1)
+                action_candidates = self.action_sampler.sample(sample_shape=(n, 1)).repeat(1, self.T, 1)
             else:
-                action_candidates = self.action_sampler.sample(sample_shape=(self.N, self.T))
-
-        # TODO
-        for t in range(self.T):
-            action_batch = action_candidates[:, t, :]
-            state_batch = states[:, t, :]
-            next_state_batch = state_batch + torch.tensor(self.model.predict(state_batch, action_batch)).float()
-            states[:, t + 1, :] = next_state_batch
-            if metric is not None:
-                rewards[:, t] = metric(next_state_batch, action_batch)
-            else:
-                rewards[:, t] = self.env.get_reward_torch(next_state_batch, action_batch)
+                action_candidates = self.action_sampler.sample(sample_shape=(n, self.T))
+        return action_candidates
 
-        # TODO compute rewards
-        cumulative_reward = torch.sum(rewards, dim=1)
+    def cem(self, state, metric=None, init=None):
+        """
+        Cross entropy method: sample N sequences from a gaussian over the T x du actions, refit the gaussian to the
+        top elites sequences and repeat for the configured number of iterations. Returns the final mean sequence.
+        The initial mean is the middle of the action space, or init (the shifted previous plan) when warm starting.
+        """
+        mean = ((self.high + self.low) / 2).repeat(self.T, 1) if init is None else init
+        std = ((self.high - self.low) / 2).repeat(self.T, 1)
+        for i in range(self.iterations):
+            if self.out_of_time(i):
+                break
+            action_candidates = self.sample_gaussian(mean, std)
+            cumulative_reward = self.rollout(state, action_candidates, metric=metric)
 
-        if False:
-            # Basic waterfall plot
-            import plotly.graph_objects as go
-            fig = go.Figure()
-            # Create and style traces
-            for i, vec in enumerate(states[:,:,0]):
-                if i < 500:
-                    fig.add_trace(go.Scatter(y=vec))
-            fig.show()
+            elite_idx = torch.topk(cumulative_reward, self.elites).indices
+            elites = action_candidates[elite_idx]
+            # smooth the update so one unlucky iteration does not collapse the distribution
+            mean = self.alpha * mean + (1 - self.alpha) * elites.mean(dim=0)
+            std = self.alpha * std + (1 - self.alpha) * elites.std(dim=0)
 
-        best = torch.argmax(cumulative_reward)
-        actions_seq = action_candidates[best, :, :]
-        best_action = actions_seq[0]
+        return mean
 
-        self.last_action = best_action
-        self.internal += 1
-        return best_action
-        # else:
-        #     self.internal += 1
-        #     best_action = self.last_action
-        #     return best_action, False
+    def mppi(self, state, metric=None, init=None):
+        """
+        MPPI style planner: perturb the mean sequence with gaussian noise and move the mean to the average of the
+        candidates, weighted by the exponentiated cumulative reward. Returns the final mean sequence.
+        The initial mean is the middle of the action space, or init (the shifted previous plan) when warm starting.
+        """
+        mean = ((self.high + self.low) / 2).repeat(self.T, 1) if init is None else init
+        std = (self.std * (self.high - self.low)).repeat(self.T, 1)
+        for i in range(self.iterations):
+            if self.out_of_time(i):
+                break
+            action_candidates = self.sample_gaussian(mean, std)
+            cumulative_reward = self.rollout(state, action_candidates, metric=metric)
+
+            weights = torch.softmax((cumulative_reward - torch.max(cumulative_reward)) / self.temperature, dim=0)
+            mean = torch.sum(weights.reshape(-1, 1, 1) * action_candidates, dim=0)
+
+        return mean
+
+    def out_of_time(self, iteration):
+        # for the iterative planners in anytime mode, stop when another iteration at the slowest rate seen so far
+        #   would pass the deadline. The first iteration always runs
+        if self.deadline <= 0 or iteration == 0:
+            return False
+        elapsed = time.perf_counter() - self.start
+        return elapsed + elapsed / iteration > self.deadline
+
+    def sample_gaussian(self, mean, std):
+        # samples N candidate sequences around the T x du mean, clipped to the action space
+        if self.hold:
+            noise = torch.randn(self.N, 1, len(self.low)).repeat(1, self.T, 1)
+        else:
+            noise = torch.randn(self.N, self.T, len(self.low))
+        action_candidates = mean + std * noise
+        return torch.max(torch.min(action_candidates, self.high), self.low)
+
+    def rollout(self, state, action_candidates, metric=None):
+        """
+        Simulates each of the N candidate action sequences through the model from the current state. The states,
+        actions and rewards stay as tensors for the whole N x T rollout, so there is no host conversion per step.
+        Returns the cumulative reward of each candidate sequence.
+        """
+        num_candidates = action_candidates.shape[0]
+        self.evaluated += num_candidates
+        state_batch = torch.as_tensor(state, dtype=torch.float32).repeat(num_candidates, 1)
+        action_candidates = action_candidates.float()
+        cumulative_reward = torch.zeros(num_candidates)
+        with torch.no_grad():
+            for t in range(self.T):
+                action_batch = action_candidates[:, t, :]
+                state_batch = state_batch + self.predict_delta(state_batch, action_batch)
+                if metric is not None:
+                    cumulative_reward += metric(state_batch, action_batch)
+                else:
+                    cumulative_reward += self.env.get_reward_torch(state_batch, action_batch)
+
+        return cumulative_reward
+
+    def predict_delta(self, state_batch, action_batch):
+        # models that only implement the NumPy predict (eg. LinearModel) still work, but pay for the conversion
+        if hasattr(self.model, 'predict_torch'):
+            return self.model.predict_torch(state_batch, action_batch)
+        return torch.as_tensor(self.model.predict(state_batch.numpy(), action_batch.numpy())).float()
@@ -144,8 +144,8 @@ class PIPPS_policy(nn.Module):
         """
         if means == [] and variances == []:
             print("loading data distribution from the dynamics model")
-            self.state_means = self.dynam_model.scalarX_tensors_mean
-            self.state_vars = self.dynam_model.scalarX_tensors_var
+            self.state_means = torch.Tensor(self.dynam_model.scalarX.mean_)
+            self.state_vars = torch.Tensor(self.dynam_model.scalarX.var_)
         else:
             self.state_means = torch.Tensor(means)
             self.state_vars = torch.Tensor(variances)
@@ -24,3 +24,13 @@ register(
 #     id='DiscreteQuadEnv-v0',
 #     entry_point='learn.envs.model_discrete:DiscreteQuadEnv',
 # )
+
+
+def make_env(params):
+    """
+    gym.make for the env section of a config (cfg.env.params), passing on the integrator settings of the rigid body
+    envs (integrator, repeat, rtol, atol, see RigidEnv) when they are set
+    """
+    import gym
+    sim = {k: params[k] for k in ('integrator', 'repeat', 'rtol', 'atol') if k in params}
+    return gym.make(params.name, **sim)
@@ -39,8 +39,9 @@ class CrazyflieRigidEnv(RigidEnv):
 
     """
 
-    def __init__(self, dt=.0025, m=.035, L=.065, Ixx=2.3951e-5, Iyy=2.3951e-5, Izz=3.2347e-5):
-        super(CrazyflieRigidEnv, self).__init__(dt=dt)
+    def __init__(self, dt=.0025, m=.035, L=.065, Ixx=2.3951e-5, Iyy=2.3951e-5, Izz=3.2347e-5, **sim):
+        # sim are the integrator settings of RigidEnv
+        super(CrazyflieRigidEnv, self).__init__(dt=dt, **sim)
 
         # Setup the parameters
         self.m = m
@@ -66,7 +67,10 @@ class CrazyflieRigidEnv(RigidEnv):
                                        dtype=np.int32)
 
     def get_obs(self):
-        return np.array(self.state[6:])
+        return self.obs_from(self.state)
+
+    def obs_from(self, state):
+        return np.array(state[..., 6:])
 
     def set_state(self, x):
         self.state = x
@@ -104,29 +108,20 @@ class CrazyflieRigidEnv(RigidEnv):
             # cost = cost_pr + lambda_omega * cost_rates
             flag1 = np.abs(pitch) < 5
             flag2 = np.abs(roll) < 5
-            rew = int(flag1) + int(flag2)
-            return rew
+            rew = flag1.astype(int) + flag2.astype(int)
+            return int(rew[0]) if was1d else rew
         else:
             pitch = np.divide(next_ob[:, 0], 180)
             roll = np.divide(next_ob[:, 1], 180)
 
             def invhuber(input):
                 input = np.abs(input)
-                if input.ndim == 1:
-                    if np.abs(input) > 5:
-                        return input ** 2
-                    else:
-                        return input
-                else:
-                    flag = np.abs(input) > 5
-                    sqr = np.power(input, 2)
-                    cost = input[np.logical_not(flag)] + sqr[flag]
-                    return cost
+                return np.where(input > 5, input ** 2, input)
 
             p = invhuber(pitch)
             r = invhuber(roll)
             cost = p + r
-        return -cost
+            return -float(cost[0]) if was1d else -cost
 
     def get_reward_torch(self, next_ob, action):
         assert torch.is_tensor(next_ob)
@@ -191,14 +186,15 @@ class CrazyflieRigidEnv(RigidEnv):
         lz = 46e-3  # axis for tauz
         c = .025  # coupling coefficient for yaw torque
 
-        # Estimates forces
-        m1 = pwm_to_thrust(PWM[0])
-        m2 = pwm_to_thrust(PWM[1])
-        m3 = pwm_to_thrust(PWM[2])
-        m4 = pwm_to_thrust(PWM[3])
+        # Estimates forces, for one PWM vector or a batch [... x 4] of them
+        PWM = np.asarray(PWM, dtype=float)
+        m1 = pwm_to_thrust(PWM[..., 0])
+        m2 = pwm_to_thrust(PWM[..., 1])
+        m3 = pwm_to_thrust(PWM[..., 2])
+        m4 = pwm_to_thrust(PWM[..., 3])
 
         Thrust = (-m1 - m2 - m3 - m4)  # pwm_to_thrust(np.sum(PWM) / (4 * 65535.0))
         taux = l * (-m1 - m2 + m3 + m4)
         tauy = l * (m1 - m2 - m3 + m4)
         tauz = -lz * c * (-m1 + m2 - m3 + m4)
-        return np.array([Thrust, taux, tauy, tauz])
+        return np.stack([Thrust, taux, tauy, tauz], axis=-1)
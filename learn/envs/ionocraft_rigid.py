@@ -10,8 +10,9 @@ from .rigidbody import RigidEnv
 
 class IonocraftRigidEnv(RigidEnv):
     def __init__(self, dt=.01, m=.00005, L=.01, Ixx=1.967 * 10 ** -9, Iyy=1.967 * 10 ** -9, Izz=3.775 * 10 ** -9,
-                 x_noise=.0001, u_noise=0):
-        super(IonocraftRigidEnv, self).__init__(dt=dt)
+                 x_noise=.0001, u_noise=0, **sim):
+        # sim are the integrator settings of RigidEnv
+        super(IonocraftRigidEnv, self).__init__(dt=dt, **sim)
 
         # Setup the parameters
         self.m = m
@@ -35,7 +36,10 @@ class IonocraftRigidEnv(RigidEnv):
                                        dtype=np.int32)
 
     def get_obs(self):
-        return np.array(self.state[6:])
+        return self.obs_from(self.state)
+
+    def obs_from(self, state):
+        return np.array(state[..., 6:])
 
     def set_state(self, x):
         self.state = x
@@ -62,29 +66,20 @@ class IonocraftRigidEnv(RigidEnv):
             # cost = cost_pr + lambda_omega * cost_rates
             flag1 = np.abs(pitch) < 5
             flag2 = np.abs(roll) < 5
-            rew = int(flag1) + int(flag2)
-            return rew
+            rew = flag1.astype(int) + flag2.astype(int)
+            return int(rew[0]) if was1d else rew
         else:
             pitch = np.divide(next_ob[:, 0], 180)
             roll = np.divide(next_ob[:, 1], 180)
 
             def invhuber(input):
                 input = np.abs(input)
-                if input.ndim == 1:
-                    if np.abs(input) > 5:
-                        return input ** 2
-                    else:
-                        return input
-                else:
-                    flag = np.abs(input) > 5
-                    sqr = np.power(input, 2)
-                    cost = input[np.logical_not(flag)] + sqr[flag]
-                    return cost
+                return np.where(input > 5, input ** 2, input)
 
             p = invhuber(pitch)
             r = invhuber(roll)
             cost = p + r
-        return -cost
+            return -float(cost[0]) if was1d else -cost
 
     def get_reward_torch(self, next_ob, action):
         assert torch.is_tensor(next_ob)
@@ -144,14 +139,15 @@ class IonocraftRigidEnv(RigidEnv):
         c = 0  # coupling coefficient for yaw torque
         beta = .6
 
-        # Estimates forces
-        m1 = pwm_to_thrust(PWM[0], beta)
-        m2 = pwm_to_thrust(PWM[1], beta)
-        m3 = pwm_to_thrust(PWM[2], beta)
-        m4 = pwm_to_thrust(PWM[3], beta)
+        # Estimates forces, for one PWM vector or a batch [... x 4] of them
+        PWM = np.asarray(PWM, dtype=float)
+        m1 = pwm_to_thrust(PWM[..., 0], beta)
+        m2 = pwm_to_thrust(PWM[..., 1], beta)
+        m3 = pwm_to_thrust(PWM[..., 2], beta)
+        m4 = pwm_to_thrust(PWM[..., 3], beta)
 
         Thrust = (-m1 - m2 - m3 - m4)  # pwm_to_thrust(np.sum(PWM) / (4 * 65535.0))
         taux = l * (-m1 - m2 + m3 + m4)
         tauy = l * (m1 - m2 - m3 + m4)
         tauz = -lz * c * (-m1 + m2 - m3 + m4)
-        return np.array([Thrust, taux, tauy, tauz])
+        return np.stack([Thrust, taux, tauy, tauz], axis=-1)
@@ -60,7 +60,12 @@ class ModelEnv(gym.Env):
 
     def step_from(self, state, action):
         # Does not work with history mode on
-        output, logvars = self.model.predict(state, action, ret_var=True)
+        if torch.is_tensor(state) and hasattr(self.model, 'predict_torch'):
+            # batched on the tensors' device, the model's normalizer does the scaling
+            with torch.no_grad():
+                output = self.model.predict_torch(state.float(), torch.as_tensor(action, dtype=torch.float32))
+        else:
+            output, logvars = self.model.predict(state, action, ret_var=True)
         next_state = state + output
 
         obs = next_state
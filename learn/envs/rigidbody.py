@@ -7,6 +7,18 @@ from gym import spaces, logger
 from gym.utils import seeding
 
 
+INTEGRATORS = ('euler', 'rk4', 'rk45')
+
+# Dormand-Prince 5(4) tableau: the stage weights, the 5th order solution and its difference to the 4th order one
+DP_A = [[1 / 5],
+        [3 / 40, 9 / 40],
+        [44 / 45, -56 / 15, 32 / 9],
+        [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+        [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656]]
+DP_B = [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]
+DP_E = [71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40]
+
+
 class RigidEnv(gym.Env):
     """
     Description:
@@ -40,14 +52,24 @@ class RigidEnv(gym.Env):
 
     """
 
-    def __init__(self, dt=.01, x_noise=.01, u_noise=0):
+    def __init__(self, dt=.01, x_noise=.01, u_noise=0, integrator='euler', repeat=10, rtol=1e-6, atol=1e-9):
         self.x_dim = 12
         self.u_dim = 4
         self.dt = dt
         self.x_noise = x_noise
 
+        # how a step is integrated: euler or rk4 with repeat fixed sub steps, or rk45 with adaptive sub steps that
+        #   keep the estimated local error under rtol * |x| + atol
+        if integrator not in INTEGRATORS:
+            raise ValueError(f"Integrator not supported {integrator}")
+        self.integrator = integrator
+        self.rtol = rtol
+        self.atol = atol
+        self.h = None  # last rk45 step size, the first guess for the next step
+        self.n_evals = 0  # calls to _derivative, for comparing the integrators
+
         # simulate ten steps per return
-        self.repeat = 10
+        self.repeat = repeat
         self.dt = self.dt/self.repeat
 
         # Setup the state indices
@@ -71,58 +93,7 @@ class RigidEnv(gym.Env):
         # We need to convert from upright orientation to N-E-Down that the simulator runs in
         # For reference, a negative thrust of -mg/4 will keep the robot stable
         u = self.pwm_thrust_torque(pwm)
-        state = self.state
-
-        for i in range(self.repeat):
-            dt = self.dt
-            u0 = u
-            x0 = state
-            idx_xyz = self.idx_xyz
-            idx_xyz_dot = self.idx_xyz_dot
-            idx_ptp = self.idx_ptp
-            idx_ptp_dot = self.idx_ptp_dot
-
-            m = self.m
-            L = self.L
-            Ixx = self.Ixx
-            Iyy = self.Iyy
-            Izz = self.Izz
-            g = self.g
-
-            Tx = np.array([Iyy / Ixx - Izz / Ixx, L / Ixx])
-            Ty = np.array([Izz / Iyy - Ixx / Iyy, L / Iyy])
-            Tz = np.array([Ixx / Izz - Iyy / Izz, 1. / Izz])
-
-            # # Add noise to input
-            # u_noise_vec = np.random.normal(
-            #     loc=0, scale=self.u_noise, size=(self.u_dim))
-            # u = u+u_noise_vec
-
-            # Array containing the forces
-            Fxyz = np.zeros(3)
-            Fxyz[0] = -1 * (math.cos(x0[idx_ptp[0]]) * math.sin(x0[idx_ptp[1]]) * math.cos(
-                x0[idx_ptp[2]]) + math.sin(x0[idx_ptp[0]]) * math.sin(x0[idx_ptp[2]])) * u0[0] / m
-            Fxyz[1] = -1 * (math.cos(x0[idx_ptp[0]]) * math.sin(x0[idx_ptp[1]]) * math.sin(
-                x0[idx_ptp[2]]) - math.sin(x0[idx_ptp[0]]) * math.cos(x0[idx_ptp[2]])) * u0[0] / m
-            Fxyz[2] = g - 1 * (math.cos(x0[idx_ptp[0]]) *
-                               math.cos(x0[idx_ptp[1]])) * u0[0] / m
-
-            # Compute the torques
-            t0 = np.array([x0[idx_ptp_dot[1]] * x0[idx_ptp_dot[2]], u0[1]])
-            t1 = np.array([x0[idx_ptp_dot[0]] * x0[idx_ptp_dot[2]], u0[2]])
-            t2 = np.array([x0[idx_ptp_dot[0]] * x0[idx_ptp_dot[1]], u0[3]])
-            Txyz = np.array([Tx.dot(t0), Ty.dot(t1), Tz.dot(t2)])
-
-            x1 = np.zeros(12)
-            x1[idx_xyz_dot] = x0[idx_xyz_dot] + dt * Fxyz
-            x1[idx_ptp_dot] = x0[idx_ptp_dot] + dt * Txyz
-            x1[idx_xyz] = x0[idx_xyz] + dt * x0[idx_xyz_dot]
-            x1[idx_ptp] = x0[idx_ptp] + dt * self.pqr2rpy(x0[idx_ptp], x0[idx_ptp_dot])
-
-            # makes states less than 1e-12 = 0
-            x1[abs(x1) < 1e-12] = 0
-            self.state = x1
-            state = x1
+        self.state = self._integrate(self.state, u)
 
         # Add noise component
         x_noise_vec = np.random.normal(
@@ -136,11 +107,118 @@ class RigidEnv(gym.Env):
 
         return obs, reward, done, {}
 
+    def _derivative(self, x0, u0):
+        """
+        Time derivative of the state under the [Thrust, Taux, Tauy, Tauz] input. Works on a single [12] state or a
+        batch [... x 12] of them with matching inputs [... x 4], the batch is computed with whole array operations.
+        """
+        m = self.m
+        L = self.L
+        Ixx = self.Ixx
+        Iyy = self.Iyy
+        Izz = self.Izz
+        g = self.g
+
+        # the layout of idx_xyz, idx_xyz_dot, idx_ptp and idx_ptp_dot, basic indexing is much cheaper on small arrays
+        c = np.cos(x0[..., 6:9])
+        s = np.sin(x0[..., 6:9])
+        c0, c1, c2 = c[..., 0], c[..., 1], c[..., 2]
+        s0, s1, s2 = s[..., 0], s[..., 1], s[..., 2]
+        w0, w1, w2 = x0[..., 9], x0[..., 10], x0[..., 11]
+        thrust = u0[..., 0] / m
+
+        dx = np.empty(np.broadcast(x0[..., :1], u0[..., :1]).shape[:-1] + (self.x_dim,))
+        dx[..., 0:3] = x0[..., 3:6]
+
+        # The forces
+        dx[..., 3] = -1 * (c0 * s1 * c2 + s0 * s2) * thrust
+        dx[..., 4] = -1 * (c0 * s1 * s2 - s0 * c2) * thrust
+        dx[..., 5] = g - 1 * (c0 * c1) * thrust
+
+        # Euler angle rates from the body rates, the rotation matrix of pqr2rpy written out
+        t1 = s1 / c1
+        dx[..., 6] = w0 + s0 * t1 * w1 + c0 * t1 * w2
+        dx[..., 7] = c0 * w1 - s0 * w2
+        dx[..., 8] = s0 / c1 * w1 + c0 / c1 * w2
+
+        # The torques
+        dx[..., 9] = (Iyy / Ixx - Izz / Ixx) * w1 * w2 + L / Ixx * u0[..., 1]
+        dx[..., 10] = (Izz / Iyy - Ixx / Iyy) * w0 * w2 + L / Iyy * u0[..., 2]
+        dx[..., 11] = (Ixx / Izz - Iyy / Izz) * w0 * w1 + 1. / Izz * u0[..., 3]
+        return dx
+
+    def _integrate(self, state, u):
+        """
+        Integrates the state (or batch of states) over one step, holding u, with the integrator of the env
+        """
+        if self.integrator == 'rk45':
+            return self._rk45(state, u)
+        for i in range(self.repeat):
+            if self.integrator == 'rk4':
+                k1 = self._derivative(state, u)
+                k2 = self._derivative(state + self.dt / 2 * k1, u)
+                k3 = self._derivative(state + self.dt / 2 * k2, u)
+                k4 = self._derivative(state + self.dt * k3, u)
+                state = state + self.dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+                self.n_evals += 4
+            else:
+                state = state + self.dt * self._derivative(state, u)
+                self.n_evals += 1
+
+            # makes states less than 1e-12 = 0
+            state[abs(state) < 1e-12] = 0
+        return state
+
+    def _rk45(self, state, u):
+        """
+        Dormand-Prince 5(4) with step size control over the whole step. A batch of states shares the step size,
+        set by the member with the largest error.
+        """
+        if state.size == 0:
+            # an empty batch (eg. every env of a VecRigidEnv done) has nothing to integrate
+            return state
+        T = self.dt * self.repeat
+        h = min(self.h or T, T)
+        t = 0.
+        k1 = self._derivative(state, u)
+        self.n_evals += 1
+        while t < T:
+            h = min(h, T - t)
+            ks = [k1]
+            for a in DP_A:
+                ks.append(self._derivative(state + h * sum(a_j * k for a_j, k in zip(a, ks)), u))
+            y = state + h * sum(b_j * k for b_j, k in zip(DP_B, ks))
+            k7 = self._derivative(y, u)
+            self.n_evals += 6
+            err = h * sum(e_j * k for e_j, k in zip(DP_E, ks + [k7]))
+            scale = self.atol + self.rtol * np.maximum(abs(state), abs(y))
+            e = np.max(np.sqrt(np.mean((err / scale) ** 2, axis=-1)))
+
+            if e <= 1:
+                t += h
+                # makes states less than 1e-12 = 0, the last stage is only reused as the next first if none were
+                small = abs(y) < 1e-12
+                if small.any():
+                    y[small] = 0
+                    k7 = self._derivative(y, u)
+                    self.n_evals += 1
+                state, k1 = y, k7
+            h = h * min(5., max(.2, .9 * e ** -.2)) if e > 0 else 5 * h
+            if not np.isfinite(h) or h < 1e-14 * T:
+                raise ValueError("Step size of the rk45 integrator underflowed, the state is not finite")
+        self.h = h
+        return state
+
     def get_obs(self):
         raise NotImplementedError("Subclass must implement this function")
 
+    def obs_from(self, state):
+        # the observation of a state or a batch of states, get_obs is this on self.state
+        raise NotImplementedError("Subclass must implement this function")
+
     def set_state(self, x):
         self.state = x
+        self.h = None
 
     def reset(self):
         x0 = np.array([0, 0, 0])
@@ -152,6 +230,8 @@ class RigidEnv(gym.Env):
 
         self.state = np.concatenate([x0, v0, ypr0, w0])
         self.steps_beyond_done = None
+        # the rk45 step size of the last episode is no guess for the new one
+        self.h = None
         return self.get_obs()
 
     def get_reward(self, next_ob, action):
@@ -161,16 +241,91 @@ class RigidEnv(gym.Env):
         raise NotImplementedError("Subclass must implement this function")
 
     def get_done(self, state):
-        # Done is pitch or roll > 35 deg
+        # Done is pitch or roll > 35 deg, for one observation or a batch of them
         max_a = np.deg2rad(45)
-        d = (abs(state[1]) > max_a) or (abs(state[0]) > max_a)
+        d = (abs(state[..., 1]) > max_a) | (abs(state[..., 0]) > max_a)
         return d
 
     def pqr2rpy(self, x0, pqr):
-        rotn_matrix = np.array([[1., math.sin(x0[0]) * math.tan(x0[1]), math.cos(x0[0]) * math.tan(x0[1])],
-                                [0., math.cos(x0[0]), -math.sin(x0[0])],
-                                [0., math.sin(x0[0]) / math.cos(x0[1]), math.cos(x0[0]) / math.cos(x0[1])]])
-        return rotn_matrix.dot(pqr)
+        # the rotation matrix product written out, so it also works on batches [... x 3]
+        s0, c0 = np.sin(x0[..., 0]), np.cos(x0[..., 0])
+        t1, c1 = np.tan(x0[..., 1]), np.cos(x0[..., 1])
+        p, q, r = pqr[..., 0], pqr[..., 1], pqr[..., 2]
+        return np.stack([p + s0 * t1 * q + c0 * t1 * r,
+                         c0 * q - s0 * r,
+                         s0 / c1 * q + c0 / c1 * r], axis=-1)
 
     def pwm_thrust_torque(self, PWM):
         raise NotImplementedError("Subclass must implement this function")
+
+
+class VecRigidEnv:
+    """
+    Steps num_envs copies of a RigidEnv (eg. CrazyflieRigidEnv, IonocraftRigidEnv) at once, the states are held as
+    one [num_envs x 12] array and integrated with the batched dynamics of the env. Each copy gets its own state
+    noise (x_noise can be a scalar or one value per env). Once a copy is done it is frozen, its reward is 0 and it
+    stays done until it is reset.
+    """
+
+    def __init__(self, env, num_envs, x_noise=None, seed=None):
+        self.env = env
+        self.num_envs = num_envs
+        self.x_dim = env.x_dim
+        self.u_dim = env.u_dim
+        self.action_space = getattr(env, 'action_space', None)
+        x_noise = env.x_noise if x_noise is None else x_noise
+        self.x_noise = np.broadcast_to(np.asarray(x_noise, dtype=float), (num_envs,)).reshape(-1, 1)
+
+        self.seed(seed)
+        self.state = None
+        self.dones = np.zeros(num_envs, dtype=bool)
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def reset(self, mask=None):
+        """
+        Resets every env (or those where mask is True) to a random state like RigidEnv.reset, returns the
+        observations of all of them
+        """
+        n = self.num_envs
+        x0 = np.zeros((n, 3))
+        v0 = self.np_random.uniform(low=-0.01, high=0.01, size=(n, 3))
+        ypr0 = self.np_random.uniform(low=-np.pi / 16., high=np.pi / 16., size=(n, 3))
+        ypr0[:, -1] = 0  # 0 out yaw
+        w0 = self.np_random.uniform(low=-0.01, high=0.01, size=(n, 3))
+        state = np.concatenate([x0, v0, ypr0, w0], axis=1)
+
+        if mask is None or self.state is None:
+            self.state = state
+            self.dones[:] = False
+        else:
+            mask = np.asarray(mask, dtype=bool)
+            self.state[mask] = state[mask]
+            self.dones[mask] = False
+        # the batch shares the rk45 step size of the env, start it again from a full step
+        self.env.h = None
+        return self.env.obs_from(self.state)
+
+    def set_state(self, x):
+        self.state = np.array(x, dtype=float).reshape(self.num_envs, self.x_dim)
+        self.dones[:] = False
+        self.env.h = None
+
+    def step(self, pwm):
+        """
+        pwm is a [num_envs x 4] array of motor commands. Returns the observations, rewards and done flags of all the
+        envs and an info dict
+        """
+        u = self.env.pwm_thrust_torque(np.broadcast_to(pwm, (self.num_envs, self.u_dim)))
+        live = ~self.dones
+        # noise is drawn for every env so each one's noise doesn't depend on when the others finish
+        noise = self.np_random.normal(size=self.state.shape) * self.x_noise
+        if live.any():
+            self.state[live] = self.env._integrate(self.state[live], u[live]) + noise[live]
+
+        obs = self.env.obs_from(self.state)
+        reward = np.where(live, self.env.get_reward(obs, u), 0)
+        self.dones = self.dones | self.env.get_done(obs)
+        return obs, reward, self.dones.copy(), {}
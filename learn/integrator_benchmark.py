@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+
+import gym
+from gym.envs.registration import load
+import numpy as np
+import pandas as pd
+
+import learn.envs
+from learn.envs.rigidbody import VecRigidEnv
+
+import logging
+import hydra
+
+log = logging.getLogger(__name__)
+
+
+def make_sim(name, scheme):
+    # a bare, noise free instance of the registered env with the integrator settings of scheme
+    env = load(gym.spec(name).entry_point)(**scheme)
+    env.x_noise = 0
+    return env
+
+
+def trajectory(env, states, pwm):
+    # integrates the batch of states through the [steps x B x 4] PWM sequence, returns every state visited
+    u = env.pwm_thrust_torque(pwm)
+    out = [states]
+    for t in range(len(pwm)):
+        out.append(env._integrate(out[-1].copy(), u[t]))
+    return np.stack(out)
+
+
+def benchmark(name, reference, schemes, num_envs=100, steps=50, seed=0):
+    """
+    Rolls num_envs random initial states through a random PWM sequence with each integrator scheme and with the
+    reference, and reports per scheme
+     - one_step: max error of a single step taken from the reference states, relative to the size of the states
+     - rollout: the same for the whole rollout
+     - evals: calls to the dynamics per step, us_step: wall time per step of the batch in microseconds
+    """
+    ref_env = make_sim(name, reference)
+    vec = VecRigidEnv(ref_env, num_envs, seed=seed)
+    vec.reset()
+    states = vec.state
+    rng = np.random.RandomState(seed)
+    high = ref_env.action_space.high
+    pwm = rng.uniform(.2 * high, .8 * high, (steps, num_envs, len(high)))
+
+    ref = trajectory(ref_env, states, pwm)
+    # rollouts that leave the flight envelope (or blow up) are not useful to compare on
+    ok = np.all(np.isfinite(ref), axis=(0, 2)) & np.all(~ref_env.get_done(ref[:, :, 6:]), axis=0)
+    ref, pwm = ref[:, ok], pwm[:, ok]
+    size = np.max(np.abs(ref), axis=(0, 1)) + 1e-12
+    log.info(f"Comparing on {int(ok.sum())} of {num_envs} rollouts that stayed in the flight envelope")
+
+    rows = []
+    for scheme in schemes:
+        env = make_sim(name, scheme)
+        u = env.pwm_thrust_torque(pwm)
+        env.n_evals = 0
+        start = time.perf_counter()
+        one = np.stack([env._integrate(ref[t].copy(), u[t]) for t in range(len(pwm))])
+        elapsed = time.perf_counter() - start
+        evals = env.n_evals / len(pwm)
+        roll = trajectory(env, ref[0], pwm)
+        rows.append(dict(scheme=', '.join(f"{k}={v}" for k, v in scheme.items()),
+                         one_step=np.max(np.abs(one - ref[1:]) / size),
+                         rollout=np.max(np.abs(roll - ref) / size),
+                         evals=evals, us_step=elapsed / len(pwm) * 1e6))
+    return pd.DataFrame(rows).set_index('scheme')
+
+
+@hydra.main(config_path='conf/integrators.yaml')
+def integrator_benchmark(cfg):
+    table = benchmark(cfg.env, dict(cfg.reference), [dict(s) for s in cfg.schemes], num_envs=cfg.num_envs,
+                      steps=cfg.steps, seed=cfg.random_seed)
+    log.info(f"Max error relative to the range of each state, dynamics calls and time per step\n{table.to_string()}")
+    table.to_csv(os.path.join(os.getcwd(), 'integrators.csv'))
+
+
+if __name__ == '__main__':
+    sys.exit(integrator_benchmark())
@@ -2,4 +2,8 @@ from .model_general_nn import GeneralNN
 from .model_ensemble_nn import EnsembleNN
 from .linear_model import LinearModel
 from .residual_model import ResidualModel
-from .model import DynamicsModel
\ No newline at end of file
+from .model import DynamicsModel
+from .checkpoint import load_model
+from .export import export_model
+from .quantize import quantize_model
+from .rigid_model import RigidBodyModel
@@ -0,0 +1,204 @@
+"""
+Checkpoint format for the NN dynamics models. Rather than pickling the whole module (and the sklearn scalers with
+it), a checkpoint is a plain dict of tensors, numbers and strings:
+ - version, cls: format version and model class name
+ - nn_params: the parameters the model was built with, as plain dicts
+ - members: one entry per network (one for GeneralNN, E for EnsembleNN) with its state_dict, the statistics of
+   its scalers and its training flags
+ - lists: the state, input and change in state column labels the model was trained on
+so it can be loaded without the class import graph of the training run, and with weights_only and mmap on torch
+versions that have them. Models pickled whole by older versions still load through load_model.
+"""
+import inspect
+import pickletools
+import re
+import sys
+import zipfile
+
+import numpy as np
+import torch
+from sklearn.preprocessing import StandardScaler, MinMaxScaler
+
+CHECKPOINT_VERSION = 1
+
+SCALERS = {'StandardScaler': StandardScaler, 'MinMaxScaler': MinMaxScaler}
+
+
+def plain_params(params):
+    # converts a (possibly nested) hydra config into dicts and lists
+    try:
+        from omegaconf import OmegaConf, DictConfig, ListConfig
+        if isinstance(params, (DictConfig, ListConfig)):
+            return OmegaConf.to_container(params, resolve=True)
+    except ImportError:
+        pass
+    if isinstance(params, dict):
+        return {k: plain_params(v) for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [plain_params(v) for v in params]
+    return params
+
+
+def scaler_state(scaler):
+    # the fitted statistics of an sklearn scaler, numeric arrays as tensors and the settings as python values
+    arrays, params = {}, {}
+    for k, v in vars(scaler).items():
+        if isinstance(v, np.ndarray):
+            if v.dtype.kind in 'biuf':
+                arrays[k] = torch.from_numpy(np.ascontiguousarray(v))
+        elif isinstance(v, np.generic):
+            params[k] = v.item()
+        else:
+            params[k] = list(v) if isinstance(v, tuple) else v
+    return dict(cls=type(scaler).__name__, arrays=arrays, params=params)
+
+
+def load_scaler(state):
+    scaler = SCALERS[state['cls']]()
+    for k, v in state['params'].items():
+        setattr(scaler, k, tuple(v) if k == 'feature_range' else v)
+    for k, v in state['arrays'].items():
+        setattr(scaler, k, v.numpy())
+    return scaler
+
+
+def model_checkpoint(model):
+    """
+    Builds the checkpoint dict of a GeneralNN or EnsembleNN
+    """
+    if getattr(model, 'nn_params', None) is None:
+        raise ValueError("This model was pickled whole by an older version and its layer sizes can't be rebuilt "
+                         "from the current constructor, so it can't be re-saved as a checkpoint (retrain it)")
+    networks = model.networks if model.E else [model]
+    members = []
+    for net in networks:
+        members.append(dict(
+            state_dict={k: v.detach().cpu() for k, v in net.state_dict().items()},
+            scalers=[scaler_state(sc) for sc in net.getNormScalers()],
+            init_training=bool(net.init_training),
+            n_trained=int(getattr(net, 'n_trained', 0)),
+        ))
+    state_list, input_list, change_state_list = model.get_training_lists()
+    return dict(
+        version=CHECKPOINT_VERSION,
+        cls=type(model).__name__,
+        nn_params=plain_params(model.nn_params),
+        members=members,
+        lists=dict(state_list=list(state_list), input_list=list(input_list),
+                   change_state_list=list(change_state_list)),
+    )
+
+
+def save_checkpoint(model, filepath):
+    torch.save(model_checkpoint(model), filepath)
+
+
+def _supported(fnc, **kwargs):
+    # drops the keyword arguments the installed torch does not have yet (weights_only, mmap, assign)
+    params = inspect.signature(fnc).parameters
+    return {k: v for k, v in kwargs.items() if k in params}
+
+
+def load_model(filepath, mmap=False):
+    """
+    Loads a model saved by save_model. With mmap the weights are memory mapped from the file rather than read in,
+    so they are only paged in when used (needs a torch with torch.load(mmap=...), otherwise it is ignored).
+    Files that hold a whole pickled model (eg. ex_data/models/*.dat) are loaded as before and brought up to date.
+    """
+    from .model_general_nn import GeneralNN
+    from .model_ensemble_nn import EnsembleNN
+
+    if not _pickles_dict(filepath):
+        return _load_legacy(filepath, (GeneralNN, EnsembleNN))
+
+    # errors loading a checkpoint are raised as they are, it is not retried as a whole pickled model
+    ckpt = torch.load(filepath, map_location='cpu', **_supported(torch.load, weights_only=True, mmap=mmap))
+    if 'version' not in ckpt:
+        raise ValueError(f"{filepath} holds a dict without a checkpoint version, not a saved model")
+    if ckpt['version'] > CHECKPOINT_VERSION:
+        raise ValueError(f"Checkpoint version {ckpt['version']} is newer than supported ({CHECKPOINT_VERSION})")
+
+    model = {'GeneralNN': GeneralNN, 'EnsembleNN': EnsembleNN}[ckpt['cls']](**ckpt['nn_params'])
+    networks = model.networks if model.E else [model]
+    for net, member in zip(networks, ckpt['members']):
+        # assign keeps the loaded (possibly memory mapped) tensors instead of copying them into new ones
+        net.load_state_dict(member['state_dict'], **_supported(net.load_state_dict, assign=True))
+        net.scalarX, net.scalarU, net.scalardX = [load_scaler(s) for s in member['scalers']]
+        net.update_normalizer()
+        net.init_training = member['init_training']
+        net.n_trained = member['n_trained']
+    model.store_training_lists(**ckpt['lists'])
+    if model.E:
+        model.stack()
+    return model
+
+
+def _pickles_dict(filepath):
+    # whether filepath was written by torch.save with a dict at the top, like the checkpoints, read from the opcodes
+    #   of its pickle without running it. Whole pickled models start with the global of their class instead
+    if not zipfile.is_zipfile(filepath):
+        return False
+    with zipfile.ZipFile(filepath) as z:
+        name = next((n for n in z.namelist() if n.rsplit('/', 1)[-1] == 'data.pkl'), None)
+        if name is None:
+            return False
+        for op, arg, pos in pickletools.genops(z.read(name)):
+            if op.name not in ('PROTO', 'FRAME'):
+                return op.name in ('EMPTY_DICT', 'DICT')
+    return False
+
+
+def _load_legacy(filepath, classes):
+    # older scikit-learn had the scalers in sklearn.preprocessing.data
+    try:
+        import sklearn.preprocessing._data
+        sys.modules.setdefault('sklearn.preprocessing.data', sklearn.preprocessing._data)
+    except ImportError:
+        pass
+
+    model = torch.load(filepath, map_location='cpu', **_supported(torch.load, weights_only=False))
+    if not isinstance(model, torch.nn.Module):
+        raise ValueError(f"{filepath} holds a {type(model).__name__}, not a checkpoint or a pickled model")
+    if isinstance(model, classes):
+        # fill in what was added since the model was pickled
+        networks = model.networks if model.E else [model]
+        for net in networks:
+            # fresh scalers with the old statistics, so settings added to sklearn since have their defaults
+            net.scalarX, net.scalarU, net.scalardX = [load_scaler(scaler_state(sc)) for sc in net.getNormScalers()]
+            net.update_normalizer()
+            if not hasattr(net, 'n_trained'):
+                net.n_trained = 0
+        if model.E:
+            model.stacked = None
+        # the pickles predate nn_params, rebuild them from the layer sizes so the model can be saved again
+        params = _legacy_params(networks[0], model.E)
+        for m in [model] + (networks if model.E else []):
+            m.nn_params = params
+    return model
+
+
+def _legacy_params(net, E=0):
+    """
+    nn_params that build a network shaped like the unpickled GeneralNN net (E members for an ensemble), or None when
+    the constructor can't make those shapes (eg. pickles from before the inputs were stacked like they are now)
+    """
+    from .model_general_nn import GeneralNN
+
+    try:
+        h = net.hist
+        extra = [c for c in net.input_list if not re.fullmatch(r'.+_\d+tu', str(c))]
+        dx, rx = divmod(net.n_in_state, h + 1)
+        du, ru = divmod(net.n_in_input - len(extra), h + 1)
+        if rx or ru:
+            return None
+        training = dict(ensemble=bool(E), E=E, probl=bool(net.prob), hid_width=net.hidden_w, hid_depth=net.depth,
+                        dropout=net.d, split=net.split_flag)
+        params = dict(training=training, history=h, extra_inputs=extra or None, du=du, dx=dx,
+                      dt=net.n_out // 2 if net.prob else net.n_out)
+        built = GeneralNN(**params).state_dict()
+    except (AttributeError, TypeError, KeyError):
+        return None
+    shapes = {k: v.shape for k, v in net.state_dict().items()}
+    if shapes != {k: v.shape for k, v in built.items()}:
+        return None
+    return params
@@ -0,0 +1,152 @@
+"""
+Distillation of a trained EnsembleNN into a single probabilistic GeneralNN (the student), which is E times cheaper
+to query in the controller loop. The student is fit to the mean and the total variance (aleatoric plus the spread of
+the member means, see EnsembleNN.members) of the ensemble on
+ - the states and inputs the ensemble was trained on
+ - states the ensemble visits when rolled out from random training rows with inputs drawn from the training data
+so it also matches the ensemble where model rollouts go, not only on the logged data.
+"""
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .model_general_nn import GeneralNN
+
+
+class DistillLoss(nn.Module):
+    """
+    Squared error of the student's normalized means against the ensemble's plus var_weight times the squared error
+    of its log variances. Same call as PNNLoss_Gaussian so it can be used by GeneralNN._optimize, but the logvar
+    bounds are not applied: the targets are already bounded, so the raw variance head is fit directly.
+    """
+
+    def __init__(self, var_weight=1.):
+        super(DistillLoss, self).__init__()
+        self.var_weight = var_weight
+
+    def forward(self, output, target, max_logvar, min_logvar):
+        d = int(output.size(1) / 2)
+        return torch.sum((output[:, :d] - target[:, :d]) ** 2) + \
+               self.var_weight * torch.sum((output[:, d:] - target[:, d:]) ** 2)
+
+
+def state_feedback(model, dx, dt):
+    """
+    Returns a function (x, out) -> next x that feeds a [N x dt] prediction back into the [N x dx] state: states
+    with a <var>_0dx target get the change added, <var>_1fx targets replace the state and the history columns
+    <var>_<k>tx shift back by one step. Without training lists the targets are taken to be the change of every
+    state (as in the simulated experiments). Returns None if the state can't be built from the prediction.
+    """
+    state_list, _, target_list = model.get_training_lists()
+    if len(state_list) == 0 or len(target_list) == 0:
+        if dx != dt:
+            return None
+        return lambda x, out: x + out
+
+    shift_to, shift_from = [], []
+    for i, s in enumerate(state_list):
+        var, k = s.rsplit('_', 1)
+        k = k[:-2]
+        if k.isdigit() and int(k) > 0 and f"{var}_{int(k) - 1}tx" in state_list:
+            shift_to.append(i)
+            shift_from.append(state_list.index(f"{var}_{int(k) - 1}tx"))
+
+    d_col, d_tgt, a_col, a_tgt = [], [], [], []
+    for j, t in enumerate(target_list):
+        var, kind = t.rsplit('_', 1)
+        if var + '_0tx' in state_list:
+            if kind.endswith('dx'):
+                d_col.append(state_list.index(var + '_0tx'))
+                d_tgt.append(j)
+            else:
+                a_col.append(state_list.index(var + '_0tx'))
+                a_tgt.append(j)
+
+    def feedback(x, out):
+        nxt = x.clone()
+        nxt[:, shift_to] = x[:, shift_from]
+        nxt[:, d_col] = x[:, d_col] + out[:, d_tgt]
+        nxt[:, a_col] = out[:, a_tgt]
+        return nxt
+
+    return feedback
+
+
+def rollout_samples(model, X, U, n, horizon):
+    """
+    Rolls the model out horizon steps from n random rows of X, each step with inputs drawn at random from the rows
+    of U. Returns the visited states paired with newly drawn inputs, [n*horizon x dx] and [n*horizon x du].
+    """
+    feedback = state_feedback(model, X.shape[1], model.p_out)
+    if feedback is None or n == 0 or horizon == 0:
+        return X[:0], U[:0]
+
+    x = X[torch.randint(len(X), (n,))]
+    states = []
+    with torch.no_grad():
+        for h in range(horizon):
+            x = feedback(x, model.predict_torch(x, U[torch.randint(len(U), (n,))]))
+            states.append(x)
+    states = torch.cat(states)
+    return states, U[torch.randint(len(U), (len(states),))]
+
+
+def distill(ensemble, X, U, model_params):
+    """
+    Trains a student on the ensemble with the settings in model_params.distill:
+     - rollouts, horizon: rolled out samples per training row and the steps of each rollout
+     - hid_width, hid_depth: size of the student, the members' by default
+     - var_weight: weight of the variance term of the loss
+     - epochs, batch, lr: training of the student, the optimizer settings of the ensemble by default
+    Returns the student with the training lists of the ensemble and its test and train losses.
+    """
+    cfg = model_params.distill
+    opt = model_params.optimizer
+    params = copy.deepcopy(ensemble.nn_params)
+    for key in ('hid_width', 'hid_depth'):
+        if cfg.get(key, None):
+            params['training'][key] = cfg[key]
+    student = GeneralNN(**params)
+    student.store_training_lists(*ensemble.get_training_lists())
+
+    X, U = torch.Tensor(np.asarray(X)), torch.Tensor(np.asarray(U))
+    X_r, U_r = rollout_samples(ensemble, X, U, int(cfg.get('rollouts', 1.) * len(X)), cfg.get('horizon', 5))
+    X, U = torch.cat((X, X_r)), torch.cat((U, U_r))
+    with torch.no_grad():
+        out = ensemble.members(X, U)
+    # rollouts can leave the region the ensemble is sane in
+    keep = torch.isfinite(out['mean']).all(dim=1)
+    if student.prob:
+        keep &= torch.isfinite(out['var']).all(dim=1) & (out['var'] > 0).all(dim=1)
+    X, U, mean = X[keep], U[keep], out['mean'][keep]
+
+    # the student gets its own scalers, fit on the distillation samples
+    inputs, outputs = student.preprocess((X.numpy(), U.numpy(), mean.numpy()))
+    if student.prob:
+        logvar = torch.log(out['var'][keep] * student.normalizer.out_scale ** 2)
+        outputs = torch.cat((outputs, logvar), dim=1)
+        with torch.no_grad():
+            # the range of the targets, kept fixed through training
+            student.max_logvar.copy_(logvar.max(dim=0)[0].reshape(1, -1))
+            student.min_logvar.copy_(logvar.min(dim=0)[0].reshape(1, -1))
+        student.max_logvar.requires_grad_(False)
+        student.min_logvar.requires_grad_(False)
+        loss_fn = DistillLoss(cfg.get('var_weight', 1.))
+    else:
+        loss_fn = nn.MSELoss()
+    student.init_weights_orth()
+    student.init_training = True
+
+    # training and rollout samples are in both the train and test split
+    perm = torch.randperm(len(inputs))
+    optimizer = torch.optim.Adam(student.parameters(), lr=cfg.get('lr', None) or opt['lr'])
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=6, gamma=0.7)
+    acctest, acctrain = student._optimize(loss_fn, optimizer, opt['split'], scheduler,
+                                          cfg.get('epochs', None) or opt['epochs'],
+                                          cfg.get('batch', None) or opt['batch'],
+                                          (inputs[perm], outputs[perm]),
+                                          nan_check=opt.get('nan_check', 0), patience=opt.get('patience', 0),
+                                          val_interval=opt.get('val_interval', 1))
+    return student, acctest, acctrain
@@ -0,0 +1,96 @@
+"""
+Export of trained GeneralNN / EnsembleNN models to a traced TorchScript graph for inference. The normalization is
+folded into the first and last layers, the variance head is dropped and the members of an ensemble are stacked,
+so the exported graph maps raw states and inputs to the mean predicted change in state in a handful of batched
+ops. Load the file with learn.control.inference.load_inference, which only needs torch.
+"""
+import json
+
+import torch
+import torch.nn as nn
+
+
+class FoldedModel(nn.Module):
+    """
+    Inference-only copy of the members of a model, [E x in x out] stacked weights with the normalizer folded in
+    """
+
+    def __init__(self, networks):
+        super(FoldedModel, self).__init__()
+        self.E = len(networks)
+        net = networks[0]
+        self.p_out = p_out = int(net.n_out / 2) if net.prob else net.n_out
+        self.B = float(getattr(net.activation, 'B', 1.))
+
+        n_layers = len([m for m in net.features if isinstance(m, nn.Linear)])
+        weights = [[] for _ in range(n_layers)]
+        biases = [[] for _ in range(n_layers)]
+        with torch.no_grad():
+            for n in networks:
+                lins = [m for m in n.features if isinstance(m, nn.Linear)]
+                norm = n.normalizer
+                for l, lin in enumerate(lins):
+                    w, b = lin.weight.detach().clone(), lin.bias.detach().clone()
+                    if l == 0:
+                        # W (x * s + t) + c = (W * s) x + (W t + c)
+                        b = b + w @ norm.in_shift
+                        w = w * norm.in_scale.reshape(1, -1)
+                    if l == n_layers - 1:
+                        # only the mean outputs, (W h + c - shift) / scale
+                        w = w[:p_out] / norm.out_scale.reshape(-1, 1)
+                        b = (b[:p_out] - norm.out_shift) / norm.out_scale
+                    weights[l].append(w.t())
+                    biases[l].append(b.reshape(1, -1))
+
+        self.n_layers = n_layers
+        for l in range(n_layers):
+            w, b = torch.stack(weights[l]), torch.stack(biases[l])
+            if self.E == 1:
+                w, b = w[0], b[0]
+            self.register_buffer('weight_' + str(l), w.contiguous())
+            self.register_buffer('bias_' + str(l), b.contiguous())
+
+    def forward(self, X, U):
+        x = torch.cat((X, U), -1)
+        if self.E > 1:
+            x = x.unsqueeze(0)
+        for l in range(self.n_layers):
+            x = torch.matmul(x, getattr(self, 'weight_' + str(l))) + getattr(self, 'bias_' + str(l))
+            if l < self.n_layers - 1:
+                # Swish as defined in learn.utils.nn
+                x = x * torch.sigmoid(-self.B * x)
+        if self.E > 1:
+            x = x.mean(dim=0)
+        return x
+
+
+def export_model(model, filepath, check=True):
+    """
+    Traces the folded model and saves it to filepath with the training lists and dimensions as metadata. With
+    check, the exported graph is compared to model.predict_torch on inputs drawn around the training data.
+    Returns the traced module.
+    """
+    networks = model.networks if model.E else [model]
+    folded = FoldedModel(networks).eval()
+
+    net = networks[0]
+    dx, du = net.n_in_state, net.n_in_input
+    # raw inputs that normalize to standard normal samples, so the check covers the range the model was fit on
+    z = torch.randn(16, dx + du, generator=torch.Generator().manual_seed(0))
+    raw = (z - net.normalizer.in_shift) / net.normalizer.in_scale
+    X, U = raw[:, :dx].contiguous(), raw[:, dx:].contiguous()
+
+    with torch.no_grad():
+        traced = torch.jit.trace(folded, (X, U))
+        if check:
+            err = torch.max(torch.abs(traced(X, U) - model.predict_torch(X, U)))
+            scale = torch.max(torch.abs(model.predict_torch(X, U)))
+            if err > 1e-4 * max(float(scale), 1.):
+                raise ValueError(f"Exported model does not match the original, max error {float(err)}")
+
+    state_list, input_list, change_state_list = model.get_training_lists()
+    meta = dict(cls=type(model).__name__, E=len(networks), dx=dx, du=du, dt=folded.p_out,
+                state_list=list(state_list), input_list=list(input_list),
+                change_state_list=list(change_state_list))
+    torch.jit.save(traced, filepath, _extra_files={'meta.json': json.dumps(meta)})
+    return traced
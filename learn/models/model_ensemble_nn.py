@@ -6,14 +6,82 @@ import numpy as np
 # Torch Packages
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.multiprocessing as mp
 # More NN such
 from sklearn.model_selection import KFold  # for dataset
+import os
 
 # neural nets
 from learn.models.model_general_nn import GeneralNN
+from learn.models.checkpoint import save_checkpoint, plain_params
 import hydra
 
 
+def _train_member(args):
+    """
+    Process pool worker for parallel ensemble training, trains one member and sends back only what changed: the
+    state_dict (its tensors go back through shared memory), the fitted scalers and the losses.
+    """
+    net, seed, threads, dataset, train_params = args
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    acctest, acctrain = net.train_cust(dataset, train_params)
+    state = {k: v.share_memory_() for k, v in net.state_dict().items()}
+    return state, net.getNormScalers(), acctest, acctrain
+
+
+class StackedEnsemble(nn.Module):
+    """
+    Holds the weights of the E trained GeneralNNs of an ensemble stacked along a leading dimension, so a forward pass
+    of the whole ensemble is one batched matmul per layer on an [E x B x H] tensor instead of E small ones. The normalization statistics of
+    each member are stacked the same way, since each member is fit on its own fold of the data.
+    """
+
+    def __init__(self, networks):
+        super(StackedEnsemble, self).__init__()
+        net = networks[0]
+        self.prob = net.prob
+        self.p_out = int(net.n_out / 2) if net.prob else net.n_out
+        self.activation = net.activation
+
+        layers = [m for m in net.features if isinstance(m, nn.Linear)]
+        self.n_layers = len(layers)
+        for l in range(self.n_layers):
+            lins = [[m for m in n.features if isinstance(m, nn.Linear)][l] for n in networks]
+            self.register_buffer('weight_' + str(l), torch.stack([lin.weight.detach().t() for lin in lins]))
+            self.register_buffer('bias_' + str(l), torch.stack([lin.bias.detach().unsqueeze(0) for lin in lins]))
+
+        def stack(tensors):
+            return torch.stack([t.detach().reshape(1, -1) for t in tensors])
+
+        for name in ('in_scale', 'in_shift', 'out_scale', 'out_shift'):
+            self.register_buffer(name, stack([getattr(n.normalizer, name) for n in networks]))
+        if self.prob:
+            self.register_buffer('max_logvar', stack([n.max_logvar for n in networks]))
+            self.register_buffer('min_logvar', stack([n.min_logvar for n in networks]))
+
+    def forward(self, x):
+        """
+        x is [E x B x n_in] (already normalized per member), returns the raw [E x B x n_out] network outputs
+        """
+        for l in range(self.n_layers):
+            x = torch.matmul(x, getattr(self, 'weight_' + str(l))) + getattr(self, 'bias_' + str(l))
+            if l < self.n_layers - 1:
+                x = self.activation(x)
+        return x
+
+    def members(self, X, U):
+        """
+        Given [B x dx] states and [B x du] inputs, returns the [E x B x dt] predicted change in state of every member,
+        the [E x B x dt] raw outputs of the variance head (or None if not probabilistic)
+        """
+        out = self.forward(torch.cat((X, U), -1).unsqueeze(0) * self.in_scale + self.in_shift)
+        means = (out[:, :, :self.p_out] - self.out_shift) / self.out_scale
+        logvar = out[:, :, self.p_out:] if self.prob else None
+        return means, logvar
+
+
 class EnsembleNN(nn.Module):
     '''
     This file is in the works for an object to easily create an ensemble model. These
@@ -22,6 +90,7 @@ class EnsembleNN(nn.Module):
 
     def __init__(self, **nn_params):
         super(EnsembleNN, self).__init__()
+        self.nn_params = plain_params(nn_params)
         self.E = nn_params['training']['E']  # number of networks to use in each ensemble
         self.prob = nn_params['training']['probl']
         self.dx = nn_params['dx']
@@ -42,6 +111,9 @@ class EnsembleNN(nn.Module):
             # self.networks.append(hydra.utils.instantiate(nn_params))
             self.networks.append(GeneralNN(**nn_params))
 
+        # stacked copy of the trained networks for batched prediction, see stack()
+        self.stacked = None
+
         # Can store with a helper function for when re-loading and figuring out what was trained on
         self.state_list = []
         self.input_list = []
@@ -51,6 +123,9 @@ class EnsembleNN(nn.Module):
         '''
         To train the enemble model simply train each subnetwork on the same data
         Will return the test and train accuracy in lists of 1d arrays
+        With training.parallel the members are trained at the same time in a pool of training.workers processes
+          (default one per member), each limited to training.threads intra-op threads (default an even share of the
+          cores). Each member is seeded from the global torch seed the same way in both modes, so the results match.
         '''
 
         acctest_l = []
@@ -59,9 +134,20 @@ class EnsembleNN(nn.Module):
         # setup cross validation-ish datasets for training ensemble
         kf = KFold(n_splits=self.E)
         kf.get_n_splits(dataset)
+        # an out of core dataset (learn.utils.stream) is split into datasets of the fold rows instead
+        stream = hasattr(dataset, 'batches')
+        n = len(dataset) if stream else len(dataset[0])
 
+        # one seed per member, drawn from the global generator so torch.manual_seed fixes the whole ensemble
+        seed = int(torch.randint(0, 2 ** 31 - 1, (1,)))
+
+        jobs = []
         # iterate through the validation sets
-        for (i, net), (train_idx, test_idx) in zip(enumerate(self.networks), kf.split(dataset[0])):
+        for (i, net), (train_idx, test_idx) in zip(enumerate(self.networks), kf.split(np.arange(n))):
+            if stream:
+                # the member initializes its loss from the fold when it starts training
+                jobs.append((net, seed + i, dataset.subset(train_idx)))
+                continue
             # only train on training data to ensure diversity
             X_cust = dataset[0][train_idx, :]
             U_cust = dataset[1][train_idx, :]
@@ -70,42 +156,124 @@ class EnsembleNN(nn.Module):
             # initializations that normally occur outside of loop
             # net.init_weights_orth()
             if self.prob: net.init_loss_fnc(dX_cust, l_mean=1, l_cov=1)  # data for std,
+            jobs.append((net, seed + i, (X_cust, U_cust, dX_cust)))
+
+        training = train_params.training
+        if training.get('parallel', False):
+            workers = training.get('workers', 0) or self.E
+            threads = training.get('threads', 0) or max(1, (os.cpu_count() or 1) // workers)
+            with mp.get_context('spawn').Pool(workers) as pool:
+                results = pool.map(_train_member, [(net, s, threads, data, train_params) for net, s, data in jobs])
+            for (net, _, _), (state, scalers, acctest, acctrain) in zip(jobs, results):
+                net.load_state_dict(state)
+                net.scalarX, net.scalarU, net.scalardX = scalers
+                net.update_normalizer()
+                net.init_training = True
+                acctest_l.append(acctest)
+                acctrain_l.append(acctrain)
+        else:
+            for net, s, data in jobs:
+                # train
+                torch.manual_seed(s)
+                acctest, acctrain = net.train_cust(data, train_params)
+                acctest_l.append(acctest)
+                acctrain_l.append(acctrain)
+
+        # every member has seen the whole dataset as far as incremental training is concerned
+        for net in self.networks:
+            net.n_trained = n
+
+        self.stack()
+        return np.transpose(np.array(self._pad(acctest_l))), np.transpose(np.array(self._pad(acctrain_l)))
 
-            # train
-            acctest, acctrain = net.train_cust((X_cust, U_cust, dX_cust), train_params)
+    def train_incremental(self, dataset, train_params):
+        '''
+        Fine tunes each member from its current weights on the new data plus a replay sample of the old data, see
+        GeneralNN.train_incremental. Each member draws its own replay sample, seeded like train_cust.
+        '''
+        if not all(net.init_training for net in self.networks):
+            return self.train_cust(dataset, train_params)
+
+        acctest_l = []
+        acctrain_l = []
+        seed = int(torch.randint(0, 2 ** 31 - 1, (1,)))
+        for i, net in enumerate(self.networks):
+            torch.manual_seed(seed + i)
+            acctest, acctrain = net.train_incremental(dataset, train_params)
             acctest_l.append(acctest)
             acctrain_l.append(acctrain)
 
-        return np.transpose(np.array(acctest_l)), np.transpose(np.array(acctrain_l))
+        self.stack()
+        return np.transpose(np.array(self._pad(acctest_l))), np.transpose(np.array(self._pad(acctrain_l)))
+
+    @staticmethod
+    def _pad(losses):
+        # members can stop early at different epochs, repeat their last loss so the lists stack
+        n = max(len(l) for l in losses)
+        return [list(l) + [l[-1]] * (n - len(l)) for l in losses]
+
+    def stack(self):
+        """
+        Builds the stacked copy of the trained networks used by the prediction functions. Must be re-run after the
+        networks are trained, train_cust does this.
+        """
+        self.stacked = StackedEnsemble(self.networks)
+        return self.stacked
+
+    def members(self, X, U, variance=True):
+        """
+        Batched prediction of every member in one pass. X and U are [B x d] tensors. Returns a dict of
+         - means, vars: [E x B x dt] per member mean change in state and variance (in state units, logvar bounded
+           by the max/min logvar learned in training)
+         - mean, var: [B x dt] aggregate, var is the average aleatoric variance plus the spread of the member means
+        The variances are skipped if variance is False or the model is not probabilistic.
+        """
+        if getattr(self, 'stacked', None) is None:
+            self.stack()
+        means, logvar = self.stacked.members(X, U)
+        out = dict(means=means, mean=means.mean(dim=0))
+        if self.prob and variance:
+            logvar = self.stacked.max_logvar - F.softplus(self.stacked.max_logvar - logvar)
+            logvar = self.stacked.min_logvar + F.softplus(logvar - self.stacked.min_logvar)
+            out['vars'] = torch.exp(logvar) / self.stacked.out_scale ** 2
+            out['var'] = out['vars'].mean(dim=0) + means.var(dim=0, unbiased=False)
+        return out
 
     def predict(self, X, U, ret_var=False):
-        prediction = np.zeros(int(self.n_out/2)) if self.prob else np.zeros(self.n_out)
-        # vars = torch.zeros(())
-        for net in self.networks:
-            if ret_var:
-                # raise NotImplementedError("Need to handle Variance Returns")
-                prediction += (1 / self.E) * net.predict(X, U)
-            else:
-                prediction += (1 / self.E) * net.predict(X, U)
+        """
+        NumPy interface to the batched ensemble prediction. Returns the mean predicted change in state and, if
+        ret_var, the log of the aggregate variance (a placeholder tensor otherwise)
+        """
+        l = np.shape(X)[0] if len(np.shape(X)) > 1 else 1
+        X = torch.as_tensor(np.asarray(X, dtype=np.float32).reshape(l, -1))
+        U = torch.as_tensor(np.asarray(U, dtype=np.float32).reshape(l, -1))
+        with torch.no_grad():
+            out = self.members(X, U, variance=ret_var)
 
+        prediction = out['mean'].numpy().squeeze()
+        if ret_var and self.prob:
+            return prediction, torch.log(out['var']).squeeze()
         return prediction, torch.Tensor(1)
 
+    def predict_torch(self, X, U):
+        """
+        Tensor version of predict, the mean of the members for [B x d] tensors X and U
+        """
+        return self.members(X, U, variance=False)['mean']
+
     def distribution(self, state, action):
         """
         Takes in a state, action pair and returns a probability distribution for each state composed of mean and variances for each state:
         - Needs to normalize the state and the action
         - Needs to scale the state and action distrubtions on the back end to match up.
         - Should be a combo of forward and pre/post processing
+        Averages the mean and the exp of the variance head of the members, computed in one batched pass so the
+        gradient path to the state and action is kept.
         """
-        dx = self.dx
-        means = torch.zeros((dx, 1))
-        var = torch.zeros((dx, 1))
-        for net in self.networks:
-            means_e, var_e = net.distribution(state, action)
-            means = means + means_e.reshape(-1, 1) / self.E
-            var = var + var_e.reshape(-1, 1) / self.E
-
-        return means.squeeze(), var.squeeze()
+        if getattr(self, 'stacked', None) is None:
+            self.stack()
+        means, logvar = self.stacked.members(state.reshape(1, -1), action.reshape(1, -1))
+        return means.mean(dim=0).squeeze(), torch.exp(logvar).mean(dim=0).squeeze()
 
     def getNormScalers(self):
         # all the data passed in is the same, so the scalers are identical
@@ -122,4 +290,5 @@ class EnsembleNN(nn.Module):
         return self.state_list, self.input_list, self.change_state_list
 
     def save_model(self, filepath):
-        torch.save(self, filepath)  # full model state
+        # weights, scaler statistics and training lists of every member, load with learn.models.load_model
+        save_checkpoint(self, filepath)
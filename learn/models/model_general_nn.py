@@ -3,8 +3,10 @@
 from ..utils.data import *
 from ..utils.nn import *
 from .model import DynamicsModel
+from .checkpoint import save_checkpoint, plain_params
 
 # Import External Packages
+import copy
 import numpy as np
 import math
 from sklearn.model_selection import train_test_split
@@ -32,6 +34,7 @@ class GeneralNN(nn.Module):
         Simpler implementation of my other neural net class. After parameter tuning, now just keep the structure and change it if needed. Note that the data passed into this network is only that which is used.
         """
         # Store the parameters:
+        self.nn_params = plain_params(nn_params)
         self.prob = nn_params['training']['probl']
         self.hidden_w = nn_params['training']['hid_width']
         self.depth = nn_params['training']['hid_depth']
@@ -57,8 +60,11 @@ class GeneralNN(nn.Module):
         self.scalarX = StandardScaler()  # MinMaxScaler(feature_range=(-1,1))#StandardScaler()# RobustScaler()
         self.scalarU = MinMaxScaler(feature_range=(-1, 1))
         self.scalardX = MinMaxScaler(feature_range=(-1, 1))
+        # torch copy of the fitted scalers used for prediction, see update_normalizer
+        self.normalizer = Normalizer(self.n_in_state, self.n_in_input, self.n_out)
 
         self.init_training = False
+        self.n_trained = 0  # rows of the dataset seen so far, used to find the new data when training incrementally
         # Sets loss function
         if self.prob:
             # INIT max/minlogvar if PNN
@@ -102,8 +108,9 @@ class GeneralNN(nn.Module):
         if not self.prob:
             raise ValueError('Attempted to set minmaxlog_var of non bayesian network')
 
-        # updates targets of the loss_fnc
-        self.loss_fnc.scalers = torch.Tensor(np.std(targets, axis=0))
+        # updates targets of the loss_fnc, an out of core dataset computes the std in a pass over its targets
+        std = targets.target_std() if hasattr(targets, 'target_std') else np.std(targets, axis=0)
+        self.loss_fnc.scalers = torch.Tensor(std)
 
         self.loss_fnc.set_lambdas(l_mean, l_cov)
 
@@ -136,20 +143,8 @@ class GeneralNN(nn.Module):
         - Should be a combo of forward and pre/post processing
         """
         # NORMALIZE ======================================================
-        # normalize states because the action gradients affect future states
-        normX_T = (state - self.scalarX_tensors_mean) / torch.sqrt(self.scalarX_tensors_var)
-        # need to normalize the action with tensors to keep the gradient path
-        U_std = (action - self.scalarU_tensors_d_min) / \
-                (self.scalarU_tensors_d_max - self.scalarU_tensors_d_min)
-        normU_T = U_std * \
-                  (self.scalarU_tensors_f_range[0] - self.scalarU_tensors_f_range[-1]) + \
-                  self.scalarU_tensors_f_range[-1]
-        # normU = self.scalarU.transform(action.reshape(1, -1))
-
-        # FORWARD ======================================================
-        # print( torch.cat((normX_T, normU_T), 1).view(-1) )
-        out = self.forward(
-            torch.cat((normX_T, normU_T), 0)).view(-1)
+        # normalize states because the action gradients affect future states, all in torch to keep the gradient path
+        out = self.forward(self.normalizer(state, action)).view(-1)
 
         # print(out)
         l = int(len(out) / 2)
@@ -157,9 +152,7 @@ class GeneralNN(nn.Module):
         logvar = out[l:]
 
         # DE-NORMALIZE ======================================================
-        # to denormalize, add 1 so 0 to 2, divide by the scale, add the min
-        means = ((means + 1.) / self.scalardX_tensors_scale) + self.scalardX_tensors_d_min
-        # means = means*self.scalarX_tensors_var[:l]+self.scalarX_tensors_mean[:l]
+        means = self.normalizer.denormalize(means)
         var = torch.exp(logvar)  # because of how the loss function is created
         return means, var
 
@@ -171,6 +164,12 @@ class GeneralNN(nn.Module):
         # [yaw, pitch, roll, x_ddot, y_ddot, z_ddot]  to
         # [sin(yaw), sin(pitch), sin(roll), cos(pitch), cos(yaw),  cos(roll), x_ddot, y_ddot, z_ddot]
         # dX = np.array([utils_data.states2delta(val) for val in X])
+        if hasattr(dataset, 'fit_scalers'):
+            # out of core, the scalers are fit in a streaming pass and the batches normalized as they are read
+            dataset.fit_scalers(self.scalarX, self.scalarU, self.scalardX)
+            self.update_normalizer()
+            return dataset
+
         if len(dataset) == 3:
             X = dataset[0]
             U = dataset[1]
@@ -183,29 +182,90 @@ class GeneralNN(nn.Module):
         self.scalardX.fit(dX)  # Note crashes with simulation when clustering.
 
         # Stores the fit as tensors for offline prediction, etc
-        if True:
-            # U is a minmax scalar from -1 to 1
-            # X is a standard scalar, mean 0, sigma 1
-            self.scalarU_tensors_d_min = torch.FloatTensor(self.scalarU.data_max_)
-            self.scalarU_tensors_d_max = torch.FloatTensor(self.scalarU.data_min_)
-            self.scalarU_tensors_d_range = torch.FloatTensor(self.scalarU.data_range_)
-            self.scalarU_tensors_f_range = torch.FloatTensor([-1, 1])
+        self.update_normalizer()
 
-            self.scalarX_tensors_mean = torch.FloatTensor(self.scalarX.mean_)
-            self.scalarX_tensors_var = torch.FloatTensor(self.scalarX.var_)
+        # Normalizing to zero mean and unit variance
+        return self.normalize(X, U, dX)
 
-            self.scalardX_tensors_d_min = torch.FloatTensor(self.scalardX.data_min_)
-            self.scalardX_tensors_scale = torch.FloatTensor(self.scalardX.scale_)
+    def normalize(self, X, U, dX):
+        """
+        Transforms raw data with the current scalers into the (inputs, outputs) tensors the network trains on
+        """
+        with torch.no_grad():
+            inputs = self.normalizer(torch.Tensor(X), torch.Tensor(U))
+            return inputs.contiguous(), self.normalizer.normalize_output(torch.Tensor(dX))
 
-        # Normalizing to zero mean and unit variance
-        normX = self.scalarX.transform(X)
-        normU = self.scalarU.transform(U)
-        normdX = self.scalardX.transform(dX)
+    def refit_scalers(self, X, U, dX):
+        """
+        Refits the scalers on the dataset X, U, dX and rescales the input and output layers so the network
+        computes the same function of the raw data as it did with the old normalization. The logvar outputs (and
+        their bounds) of a probabilistic network are shifted by the change in the output scale.
+        """
+        old = [Normalizer.affine(sc) for sc in (self.scalarX, self.scalarU, self.scalardX)]
+        self.scalarX.fit(X)
+        self.scalarU.fit(U)
+        self.scalardX.fit(dX)
+        new = [Normalizer.affine(sc) for sc in (self.scalarX, self.scalarU, self.scalardX)]
+
+        # inputs: x_old = x_new * r + t, folded into the first layer
+        r = np.concatenate([a_o / a_n for (a_o, _), (a_n, _) in zip(old[:2], new[:2])])
+        t = np.concatenate([b_o - b_n * a_o / a_n for (a_o, b_o), (a_n, b_n) in zip(old[:2], new[:2])])
+        r, t = torch.Tensor(r), torch.Tensor(t)
+        # outputs: y_new = (y_old - b_old) * a_new / a_old + b_new, folded into the last layer
+        (a_o, b_o), (a_n, b_n) = old[2], new[2]
+        k = torch.Tensor(a_n / a_o)
+        b_o, b_n = torch.Tensor(b_o), torch.Tensor(b_n)
+
+        lins = [m for m in self.features if isinstance(m, nn.Linear)]
+        with torch.no_grad():
+            first, last = lins[0], lins[-1]
+            first.bias.add_(first.weight @ t)
+            first.weight.mul_(r.reshape(1, -1))
+
+            p = len(k)
+            last.weight[:p].mul_(k.reshape(-1, 1))
+            last.bias[:p] = (last.bias[:p] - b_o) * k + b_n
+            if self.prob:
+                shift = 2 * torch.log(k)
+                last.bias[p:] += shift
+                self.max_logvar += shift
+                self.min_logvar += shift
+
+        self.update_normalizer()
+
+    def train_incremental(self, dataset, model_params):
+        """
+        Continues training from the current weights after the dataset has grown. The scalers are refit on all of
+        the data (see refit_scalers) and the network is fine tuned on the rows added since it was last trained
+        plus training.replay times as many rows sampled from the older data, so each retrain costs about the same.
+        Falls back to train_cust if the network has not been trained yet.
+        """
+        if not self.init_training or getattr(self, 'n_trained', 0) == 0:
+            return self.train_cust(dataset, model_params)
 
-        inputs = torch.Tensor(np.concatenate((normX, normU), axis=1))
-        outputs = torch.Tensor(normdX)
+        X, U, dX = [np.asarray(d) for d in dataset]
+        self.refit_scalers(X, U, dX)
 
-        return list(zip(inputs, outputs))
+        n_old = min(self.n_trained, len(X))
+        new_idx = np.arange(n_old, len(X))
+        n_replay = min(n_old, int(model_params.training.get('replay', 1.) * max(len(new_idx), 1)))
+        replay_idx = torch.randperm(n_old)[:n_replay].numpy()
+        idx = np.concatenate((new_idx, replay_idx))
+        # mix the new and replayed rows so both land in the train and test splits
+        idx = idx[torch.randperm(len(idx)).numpy()]
+
+        self.n_trained = len(X)
+        return self.train_cust(self.normalize(X[idx], U[idx], dX[idx]), model_params, preprocess=False)
+
+    def update_normalizer(self):
+        """
+        Copies the fit of the scalers into the normalizer used for prediction. Re-run whenever the scalers change.
+        """
+        if getattr(self, 'normalizer', None) is None:
+            # models pickled before the normalizer existed
+            p_out = int(self.n_out / 2) if self.prob else self.n_out
+            self.normalizer = Normalizer(self.n_in_state, self.n_in_input, p_out)
+        self.normalizer.set_scalers(self.scalarX, self.scalarU, self.scalardX)
 
     def postprocess(self, dX):
         """
@@ -219,23 +279,26 @@ class GeneralNN(nn.Module):
         dX = self.scalardX.inverse_transform(dX.reshape(l, -1)).squeeze()
         return np.array(dX)
 
-    def train_cust(self, dataset, model_params, gradoff=False):
+    def train_cust(self, dataset, model_params, gradoff=False, preprocess=None):
         """
         Train the neural network.
         if preprocess = False
-            dataset is a list of tuples to train on, where the first value in the tuple is the training data (should be implemented as a torch tensor), and the second value in the tuple
-            is the label/action taken
+            dataset is the (inputs, outputs) pair of normalized tensors to train on, a list of (input, output)
+            tuples is still accepted and is stacked once
         if preprocess = True
             dataset is simply the raw output of generate data (X, U)
+        dataset can also be an out of core learn.utils.stream.MemmapDataset, it is read from disk a batch at a time
         Epochs is number of times to train on given training data,
         batch_size is hyperparameter dicating how large of a batch to use for training,
         optim is the optimizer to use (options are "Adam", "SGD")
         split is train/test split ratio
+        preprocess overrides the optimizer setting if given
         """
         # Handle inizializations on first call
+        stream = hasattr(dataset, 'batches')
         if self.init_training == False:
             self.init_weights_orth()
-            if self.prob: self.init_loss_fnc(np.array(dataset[2]), l_mean=1, l_cov=1)  # data for std,
+            if self.prob: self.init_loss_fnc(dataset if stream else np.array(dataset[2]), l_mean=1, l_cov=1)
         self.init_training = True
 
         train_params = model_params.optimizer
@@ -245,11 +308,15 @@ class GeneralNN(nn.Module):
         lr = train_params['lr']
         lr_step_eps = train_params['lr_schedule'][0]
         lr_step_ratio = train_params['lr_schedule'][1]
-        preprocess = train_params['preprocess']
+        if preprocess is None:
+            preprocess = train_params['preprocess']
 
         if preprocess:
+            self.n_trained = len(dataset) if stream else len(dataset[0])
             dataset = self.preprocess(dataset)  # [0], dataset[1])
             # print('Shape of dataset is:', len(dataset))
+        elif not stream and not (len(dataset) == 2 and torch.is_tensor(dataset[0]) and dataset[0].dim() == 2):
+            dataset = (torch.stack([d[0] for d in dataset]), torch.stack([d[1] for d in dataset]))
 
         if self.prob:
             loss_fn = PNNLoss_Gaussian(idx=np.arange(0, self.n_out / 2, 1))
@@ -262,9 +329,6 @@ class GeneralNN(nn.Module):
         if loss_fn == PNNLoss_Gaussian() and not self.prob:
             raise ValueError('Check NN settings. Training a deterministic net with pnnLoss. Pass MSELoss() to train()')
 
-        trainLoader = DataLoader(dataset[:int(split * len(dataset))], batch_size=batch_size, shuffle=True)
-        testLoader = DataLoader(dataset[int(split * len(dataset)):], batch_size=batch_size)
-
         # Papers seem to say ADAM works better
         optimizer = torch.optim.Adam(super(GeneralNN, self).parameters(), lr=lr)
         # optimizer = torch.optim.SGD(super(GeneralNN, self).parameters(), lr=lr)
@@ -272,7 +336,9 @@ class GeneralNN(nn.Module):
                                                     gamma=0.7)  # most results at .6 gamma, tried .33 when got NaN
 
         testloss, trainloss = self._optimize(self.loss_fnc, optimizer, split, scheduler, epochs, batch_size,
-                                             dataset)  # trainLoader, testLoader)
+                                             dataset, nan_check=train_params.get('nan_check', 0),
+                                             patience=train_params.get('patience', 0),
+                                             val_interval=train_params.get('val_interval', 1))
         return testloss, trainloss
 
     def predict(self, X, U, ret_var=False):
@@ -284,37 +350,107 @@ class GeneralNN(nn.Module):
         else:
             l = 1
 
-        normX = self.scalarX.transform(X.reshape(l, -1))
-        normU = self.scalarU.transform(U.reshape(l, -1))
-
-        input = torch.Tensor(np.concatenate((normX, normU), axis=1))
-
-        NNout = self.forward(input).data
+        X = torch.as_tensor(np.asarray(X, dtype=np.float32).reshape(l, -1))
+        U = torch.as_tensor(np.asarray(U, dtype=np.float32).reshape(l, -1))
+        with torch.no_grad():
+            NNout = self.forward(self.normalizer(X, U))
 
         # If probablistic only takes the first half of the outputs for predictions
         if self.prob:
-            ret = self.postprocess(NNout[:, :int(self.n_out / 2)]).squeeze()
+            ret = self.normalizer.denormalize(NNout[:, :int(self.n_out / 2)]).numpy().squeeze()
             if ret_var:
                 return ret, NNout[:, int(self.n_out / 2):]
         else:
-            ret = self.postprocess(NNout).squeeze()
+            ret = self.normalizer.denormalize(NNout).numpy().squeeze()
 
         return ret
 
+    def predict_torch(self, X, U):
+        """
+        Tensor version of predict for batched rollouts (eg. MPC). X and U are [N x d] tensors, the normalization,
+        forward pass and de-normalization are all done with torch operations so there is no NumPy round trip.
+        Returns the [N x dt] predicted change in state as a tensor.
+        """
+        NNout = self.forward(self.normalizer(X, U))
+
+        # If probablistic only takes the first half of the outputs for predictions
+        if self.prob:
+            NNout = NNout[:, :int(self.n_out / 2)]
+
+        return self.normalizer.denormalize(NNout)
+
     def _optimize(self, loss_fn, optim, split, scheduler, epochs, batch_size, dataset,
-                  gradoff=False):  # trainLoader, testLoader):
+                  gradoff=False, nan_check=0, patience=0, val_interval=1):  # trainLoader, testLoader):
+        """
+        The losses are summed on the tensors' device and only read back once per epoch, when they are checked to be
+        finite. With nan_check > 0 the loss of every batch is also checked before its step: a batch with a NaN or
+        inf loss is skipped, and after nan_check of them in an epoch training stops. When training stops on a NaN
+        the weights and optimizer state are put back to those of the last good epoch, some diagnostics are printed
+        and the losses end with a nan.
+        The test split is evaluated every val_interval epochs (and after the last one), so the test losses returned
+        are only those epochs. Training stops early after patience evaluations without a new best test loss (0 runs
+        all the epochs) and the weights with the best test loss are restored at the end.
+        """
         errors = []
         error_train = []
         split = split
 
-        testLoader = DataLoader(dataset[int(split * len(dataset)):], batch_size=batch_size)
-        trainLoader = DataLoader(dataset[:int(split * len(dataset))], batch_size=batch_size, shuffle=True)
+        if hasattr(dataset, 'batches'):
+            # out of core, the batches are read from disk and normalized by a prefetch thread, see learn.utils.stream
+            train_set, test_set = dataset.split(split)
+            n_train, n_test = len(train_set), len(test_set)
+
+            def train_batches():
+                return train_set.batches(batch_size, self.normalize)
 
+            def test_batches():
+                return test_set.batches(batch_size, self.normalize, shuffle=False)
+        else:
+            # the data stays as two contiguous tensors, batches are gathered by indexing with a random permutation
+            inputs, targets = dataset
+            n_train = int(split * len(inputs))
+            train_in, train_targ = inputs[:n_train].contiguous(), targets[:n_train].contiguous()
+            test_in, test_targ = inputs[n_train:].contiguous(), targets[n_train:].contiguous()
+            n_test = len(test_in)
+
+            def train_batches():
+                perm = torch.randperm(n_train)
+                for i in range(n_train_batches):
+                    idx = perm[i * batch_size:(i + 1) * batch_size]
+                    yield train_in[idx], train_targ[idx]
+
+            def test_batches():
+                for i in range(n_test_batches):
+                    yield test_in[i * batch_size:(i + 1) * batch_size], test_targ[i * batch_size:(i + 1) * batch_size]
+        n_train_batches = math.ceil(n_train / batch_size)
+        n_test_batches = math.ceil(n_test / batch_size)
+        device = next(self.parameters()).device
+
+        def snapshot():
+            return {k: v.detach().clone() for k, v in self.state_dict().items()}, copy.deepcopy(optim.state_dict())
+
+        def abort(epoch, batch, input, target, output):
+            # Some errors make the loss NaN. this is a problem.
+            print(f"loss is NaN, epoch {epoch} before batch {batch} / {n_train_batches}")
+            print(f"  last batch finite: input {bool(torch.isfinite(input).all())}, target "
+                  f"{bool(torch.isfinite(target).all())}, output {bool(torch.isfinite(output).all())}")
+            if self.prob:
+                print(f"  max_logvar {self.max_logvar.data}, min_logvar {self.min_logvar.data}")
+            # go back to the weights and optimizer state from the last epoch that passed
+            self.load_state_dict(good_state[0])
+            optim.load_state_dict(good_state[1])
+            errors.append(np.nan)
+            error_train.append(np.nan)
+            return errors, error_train
+
+        good_state = snapshot()
+        best_loss, best_state, since_best = np.inf, None, 0
         for epoch in range(epochs):
 
-            avg_loss = torch.zeros(1)
-            # num_batches = len(trainLoader) / batch_size
-            for i, (input, target) in enumerate(trainLoader):
+            avg_loss = torch.zeros(1, device=device)
+            skipped = 0
+            for i, (input, target) in enumerate(train_batches()):
+                input, target = input.to(device), target.to(device)
                 # Add noise to the batch
                 if False:
                     if self.prob:
@@ -339,38 +475,56 @@ class GeneralNN(nn.Module):
                 if self.prob:
                     loss += lambda_logvar * torch.sum((self.max_logvar)) - lambda_logvar * torch.sum((self.min_logvar))
 
-                if loss.data.numpy() == loss.data.numpy():
-                    if not gradoff:
-                        loss.backward()  # backpropagate from the loss to fill the gradient buffers
-                        optim.step()  # do a gradient descent step
+                if nan_check and not torch.isfinite(loss):
+                    # don't step on this batch, the weights stay as they are
+                    skipped += 1
+                    if skipped >= nan_check:
+                        return abort(epoch, i + 1, input, target, output)
+                    continue
 
-                # if not loss.data.numpy() == loss.data.numpy(): # Some errors make the loss NaN. this is a problem.
-                else:
-                    print("loss is NaN")  # This is helpful: it'll catch that when it happens,
-                    # print("Output: ", output, "\nInput: ", input, "\nLoss: ", loss)
-                    errors.append(np.nan)
-                    error_train.append(np.nan)
-                    return errors, error_train  # and give the output and input that made the loss NaN
-                avg_loss += loss.item() / (
-                        len(trainLoader) * batch_size)  # update the overall average loss with this batch's loss
-
-            test_error = torch.zeros(1)
-            for i, (input, target) in enumerate(testLoader):
-                output = self.forward(input)
-                if self.prob:
-                    loss = loss_fn(output, target, self.max_logvar, self.min_logvar)  # compute the loss
-                else:
-                    loss = loss_fn(output, target)
+                if not gradoff:
+                    loss.backward()  # backpropagate from the loss to fill the gradient buffers
+                    optim.step()  # do a gradient descent step
+
+                # update the overall average loss with this batch's loss, a NaN anywhere in the epoch stays in the sum
+                avg_loss += loss.detach() / (n_train_batches * batch_size)
+
+            if not torch.isfinite(avg_loss).all():
+                return abort(epoch, n_train_batches, input, target, output)
+            good_state = snapshot()
+            error_train.append(avg_loss.data[0].cpu().numpy())
+            scheduler.step()
+
+            if (epoch + 1) % val_interval != 0 and epoch != epochs - 1:
+                continue
+            test_error = torch.zeros(1, device=device)
+            with torch.no_grad():
+                for input, target in test_batches():
+                    input, target = input.to(device), target.to(device)
+                    output = self.forward(input)
+                    if self.prob:
+                        loss = loss_fn(output, target, self.max_logvar, self.min_logvar)  # compute the loss
+                    else:
+                        loss = loss_fn(output, target)
 
-                test_error += loss.item() / (len(testLoader) * batch_size)
-            test_error = test_error
+                    test_error += loss / (n_test_batches * batch_size)
             # if (epoch % 1 == 0): print("Epoch:", '%04d' % (epoch + 1), "train loss=", "{:.6f}".format(avg_loss.data[0]),
             #                            "test loss=", "{:.6f}".format(test_error.data[0]))
-            error_train.append(avg_loss.data[0].numpy())
-            errors.append(test_error.data[0].numpy())
-            scheduler.step()
+            errors.append(test_error.data[0].cpu().numpy())
+
+            # keep the best weights on the test split, there is nothing to compare with an empty one
+            if n_test > 0:
+                if errors[-1] < best_loss:
+                    best_loss, best_state, since_best = errors[-1], good_state[0], 0
+                else:
+                    since_best += 1
+                if patience and since_best >= patience:
+                    break
 
+        if best_state is not None:
+            self.load_state_dict(best_state)
         return errors, error_train
 
     def save_model(self, filepath):
-        torch.save(self, filepath)
+        # weights, scaler statistics and training lists only, load with learn.models.load_model
+        save_checkpoint(self, filepath)
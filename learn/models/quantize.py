@@ -0,0 +1,152 @@
+"""
+Reduced precision inference for trained GeneralNN / EnsembleNN models and a report of what it costs in accuracy.
+ - int8: dynamic quantization of the Linear layers (weights stored as int8, activations quantized on the fly)
+ - bf16: weights and activations in bfloat16 (needs a torch with bfloat16 matmul on the CPU)
+The normalization stays in float32 either way. See learn/quantize_report.py for running the report on ex_data.
+"""
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+MODES = ('int8', 'bf16')
+
+
+class ReducedPrecisionModel:
+    """
+    Inference-only copy of a model at lower precision, with the predict / predict_torch interface of the model so
+    it can be used by MPController or ModelEnv.
+    """
+
+    def __init__(self, model, mode='int8'):
+        if mode not in MODES:
+            raise ValueError(f"Precision mode not supported {mode}")
+        self.mode = mode
+        networks = model.networks if model.E else [model]
+        self.E = model.E
+        self.prob = networks[0].prob
+        self.p_out = int(networks[0].n_out / 2) if self.prob else networks[0].n_out
+        self.state_list, self.input_list, self.change_state_list = model.get_training_lists()
+
+        self.members = []
+        for net in networks:
+            features = copy.deepcopy(net.features).eval()
+            if mode == 'int8':
+                features = torch.quantization.quantize_dynamic(features, {nn.Linear}, dtype=torch.qint8)
+            else:
+                features = features.to(torch.bfloat16)
+            self.members.append((features, copy.deepcopy(net.normalizer)))
+
+    def get_training_lists(self):
+        return self.state_list, self.input_list, self.change_state_list
+
+    def predict_torch(self, X, U):
+        # mean of the members like the float models
+        pred = 0
+        with torch.no_grad():
+            for features, normalizer in self.members:
+                x = normalizer(X, U)
+                if self.mode == 'bf16':
+                    x = x.to(torch.bfloat16)
+                out = features(x)[:, :self.p_out].float()
+                pred = pred + normalizer.denormalize(out)
+        return pred / len(self.members)
+
+    def predict(self, X, U):
+        l = np.shape(X)[0] if len(np.shape(X)) > 1 else 1
+        X = torch.as_tensor(np.asarray(X, dtype=np.float32).reshape(l, -1))
+        U = torch.as_tensor(np.asarray(U, dtype=np.float32).reshape(l, -1))
+        return self.predict_torch(X, U).numpy().squeeze()
+
+
+def quantize_model(model, mode='int8'):
+    return ReducedPrecisionModel(model, mode=mode)
+
+
+def multistep(model, states, inputs, state_list, target_list, starts, horizon):
+    """
+    Rolls the model forward horizon steps from the logged states at rows starts, with the logged inputs. Targets
+    named <var>_0dx are added to the <var>_0tx state column, <var>_1fx targets replace it. History columns and state
+    columns without a matching target are taken from the log (teacher forced).
+    Returns the [horizon x S x n] predicted values of the fed back state columns and their indices in the state.
+    """
+    delta, absolute = [], []
+    for j, t in enumerate(target_list):
+        var, kind = t.rsplit('_', 1)
+        col = var + '_0tx'
+        if col in state_list:
+            (delta if kind.endswith('dx') else absolute).append((state_list.index(col), j))
+    cols = [c for c, _ in delta + absolute]
+    d_col, d_tgt = [c for c, _ in delta], [j for _, j in delta]
+    a_col, a_tgt = [c for c, _ in absolute], [j for _, j in absolute]
+
+    x = states[starts]
+    preds = []
+    with torch.no_grad():
+        for h in range(horizon):
+            out = model.predict_torch(x, inputs[starts + h])
+            nxt = states[starts + h + 1].clone()
+            nxt[:, d_col] = x[:, d_col] + out[:, d_tgt]
+            nxt[:, a_col] = out[:, a_tgt]
+            preds.append(nxt[:, cols])
+            x = nxt
+    return torch.stack(preds), cols
+
+
+def accuracy_report(model, reduced, df, horizons=(1, 5, 10), batch=500, reps=50):
+    """
+    Compares a reduced precision model with the float model it came from on a logged dataset (eg. ex_data/SAS):
+     - one_step: mean squared error of the predicted targets against the logged targets
+     - multi-step, per horizon: error of the rolled out states against the log, see multistep
+     - divergence: mean squared difference between the reduced and the float predictions
+     - throughput: predict_torch calls per second on a batch of rows
+    Errors are divided by the variance of each column so differently scaled states can be averaged.
+    Returns a dict of float / reduced / divergence rows keyed by 'one_step' and 'h<horizon>', and 'throughput' with
+    the calls per second of both and the speedup.
+    """
+    state_list, input_list, target_list = model.get_training_lists()
+    states = torch.Tensor(df[state_list].values)
+    inputs = torch.Tensor(df[input_list].values)
+    targets = torch.Tensor(df[target_list].values)
+
+    def nmse(a, b, var):
+        return float(torch.mean((a - b) ** 2 / var))
+
+    report = dict()
+    with torch.no_grad():
+        f_out, r_out = model.predict_torch(states, inputs), reduced.predict_torch(states, inputs)
+    t_var = targets.var(dim=0) + 1e-12
+    report['one_step'] = dict(float=nmse(f_out, targets, t_var), reduced=nmse(r_out, targets, t_var),
+                              divergence=nmse(r_out, f_out, t_var))
+
+    # starting rows whose whole horizon stays inside one logged trajectory
+    H = max(horizons)
+    n = len(df)
+    ends = df['term'].values.astype(bool) if 'term' in df else np.zeros(n, dtype=bool)
+    breaks = np.concatenate(([0], np.cumsum(ends)))
+    starts = np.arange(n - H)
+    starts = starts[breaks[starts + H] - breaks[starts] == 0]
+    if len(starts) > 0:
+        f_pred, cols = multistep(model, states, inputs, state_list, target_list, starts, H)
+        r_pred, _ = multistep(reduced, states, inputs, state_list, target_list, starts, H)
+        s_var = states[:, cols].var(dim=0) + 1e-12
+        for h in horizons:
+            truth = states[starts + h][:, cols]
+            report['h' + str(h)] = dict(float=nmse(f_pred[h - 1], truth, s_var),
+                                        reduced=nmse(r_pred[h - 1], truth, s_var),
+                                        divergence=nmse(r_pred[h - 1], f_pred[h - 1], s_var))
+
+    def rate(m):
+        X, U = states[:batch], inputs[:batch]
+        with torch.no_grad():
+            m.predict_torch(X, U)
+            t = time.perf_counter()
+            for _ in range(reps):
+                m.predict_torch(X, U)
+        return reps / (time.perf_counter() - t)
+
+    f_rate, r_rate = rate(model), rate(reduced)
+    report['throughput'] = dict(float=f_rate, reduced=r_rate, speedup=r_rate / f_rate)
+    return report
@@ -0,0 +1,171 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class RigidBodyModel(nn.Module):
+    """
+    Torch version of the rigid body simulation in learn.envs.rigidbody (RigidEnv.step with the pwm_thrust_torque of
+    CrazyflieRigidEnv or IonocraftRigidEnv), without the state noise. Everything is batched and differentiable with
+    respect to the state, the PWM inputs and the physical parameters m, L, Ixx, Iyy and Izz, which are Parameters.
+    States are either the full [... x 12] simulator state or the [... x 6] observation (yaw, pitch, roll and the
+    body rates), whose dynamics don't depend on the position and velocity. It has the predict / predict_torch
+    interface of the learned models, so it can be handed to MPController as a ground truth model.
+    The step is integrated like the env, with euler or rk4 sub steps or adaptive rk45 (see RigidEnv).
+    """
+
+    def __init__(self, robot='crazyflie', dt=.0025, repeat=10, m=.035, L=.065, Ixx=2.3951e-5, Iyy=2.3951e-5,
+                 Izz=3.2347e-5, g=9.81, integrator='euler', rtol=1e-6, atol=1e-9):
+        super(RigidBodyModel, self).__init__()
+        if robot not in ('crazyflie', 'ionocraft'):
+            raise ValueError(f"Robot not supported {robot}")
+        if integrator not in ('euler', 'rk4', 'rk45'):
+            raise ValueError(f"Integrator not supported {integrator}")
+        self.robot = robot
+        self.integrator = integrator
+        self.rtol = rtol
+        self.atol = atol
+        self.repeat = repeat
+        # the env integrates repeat sub steps of dt / repeat per step
+        self.dt = dt / repeat
+
+        # scalars in double precision, the computation is done in the precision of the states passed in
+        self.m = nn.Parameter(torch.tensor(m, dtype=torch.float64))
+        self.L = nn.Parameter(torch.tensor(L, dtype=torch.float64))
+        self.Ixx = nn.Parameter(torch.tensor(Ixx, dtype=torch.float64))
+        self.Iyy = nn.Parameter(torch.tensor(Iyy, dtype=torch.float64))
+        self.Izz = nn.Parameter(torch.tensor(Izz, dtype=torch.float64))
+        self.register_buffer('g', torch.tensor(g, dtype=torch.float64))
+
+    @classmethod
+    def from_env(cls, env):
+        """
+        Builds the model with the robot, time step, integrator and physical parameters of a CrazyflieRigidEnv or
+        IonocraftRigidEnv
+        """
+        robot = 'ionocraft' if type(env).__name__.lower().startswith('iono') else 'crazyflie'
+        return cls(robot=robot, dt=env.dt * env.repeat, repeat=env.repeat, m=env.m, L=env.L, Ixx=env.Ixx,
+                   Iyy=env.Iyy, Izz=env.Izz, g=env.g, integrator=env.integrator, rtol=env.rtol, atol=env.atol)
+
+    def pwm_thrust_torque(self, PWM):
+        """
+        [... x 4] PWM values to the [Thrust, Taux, Tauy, Tauz] input of the rigid body, see the envs for the fits
+        """
+        if self.robot == 'crazyflie':
+            pwm_n = PWM / 65535.0
+            m1, m2, m3, m4 = (.35 * pwm_n + .26 * pwm_n ** 2).unbind(-1)
+            l = 35.527e-3 / math.sqrt(2)
+            lz = 46e-3
+            c = .025
+        else:
+            mu = 2 * 10 ** -4
+            beta = .6
+            I = (PWM / 3000) * .5 * 10 ** -3
+            m1, m2, m3, m4 = ((beta * I * (500 * 10 ** -6)) / mu).unbind(-1)
+            l = self.L / math.sqrt(2)
+            lz = 0
+            c = 0
+
+        Thrust = (-m1 - m2 - m3 - m4)
+        taux = l * (-m1 - m2 + m3 + m4)
+        tauy = l * (m1 - m2 - m3 + m4)
+        tauz = -lz * c * (-m1 + m2 - m3 + m4)
+        return torch.stack([Thrust, taux, tauy, tauz], dim=-1)
+
+    def derivative(self, x, u):
+        """
+        Time derivative of the [... x 12] states or [... x 6] observations under the thrust and torques u
+        """
+        full = x.shape[-1] == 12
+        att = x[..., 6:] if full else x
+        m, L, Ixx, Iyy, Izz = self.m, self.L, self.Ixx, self.Iyy, self.Izz
+
+        c0, c1, c2 = torch.cos(att[..., :3]).unbind(-1)
+        s0, s1, s2 = torch.sin(att[..., :3]).unbind(-1)
+        w0, w1, w2 = att[..., 3:].unbind(-1)
+
+        # Euler angle rates from the body rates, as RigidEnv.pqr2rpy
+        t1 = s1 / c1
+        d_att = torch.stack([w0 + s0 * t1 * w1 + c0 * t1 * w2,
+                             c0 * w1 - s0 * w2,
+                             s0 / c1 * w1 + c0 / c1 * w2,
+                             (Iyy / Ixx - Izz / Ixx) * w1 * w2 + L / Ixx * u[..., 1],
+                             (Izz / Iyy - Ixx / Iyy) * w0 * w2 + L / Iyy * u[..., 2],
+                             (Ixx / Izz - Iyy / Izz) * w0 * w1 + 1. / Izz * u[..., 3]], dim=-1)
+        if not full:
+            return d_att
+
+        thrust = u[..., 0] / m
+        forces = torch.stack([-1 * (c0 * s1 * c2 + s0 * s2) * thrust,
+                              -1 * (c0 * s1 * s2 - s0 * c2) * thrust,
+                              self.g - 1 * (c0 * c1) * thrust], dim=-1)
+        return torch.cat((x[..., 3:6], forces, d_att), dim=-1)
+
+    def forward(self, x, pwm):
+        """
+        The state after one env step from x under the PWM inputs pwm
+        """
+        u = self.pwm_thrust_torque(pwm)
+        if self.integrator == 'rk45':
+            return self._rk45(x, u)
+        for i in range(self.repeat):
+            if self.integrator == 'rk4':
+                k1 = self.derivative(x, u)
+                k2 = self.derivative(x + self.dt / 2 * k1, u)
+                k3 = self.derivative(x + self.dt / 2 * k2, u)
+                k4 = self.derivative(x + self.dt * k3, u)
+                x = x + self.dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            else:
+                x = x + self.dt * self.derivative(x, u)
+            # makes states less than 1e-12 = 0, like the env
+            x = torch.where(torch.abs(x) < 1e-12, torch.zeros_like(x), x)
+        return x
+
+    def _rk45(self, x, u):
+        """
+        Dormand-Prince 5(4) over the whole step like RigidEnv._rk45, the batch shares the step size. Runs in double
+        precision, the tolerances are below what float32 resolves, and every call starts from a full step so the
+        result only depends on the inputs. The step size control is not differentiated through.
+        """
+        from ..envs.rigidbody import DP_A, DP_B, DP_E
+
+        dtype = x.dtype
+        x, u = x.double(), u.double()
+        T = self.dt * self.repeat
+        h, t = T, 0.
+        k1 = self.derivative(x, u)
+        while t < T:
+            h = min(h, T - t)
+            ks = [k1]
+            for a in DP_A:
+                ks.append(self.derivative(x + h * sum(a_j * k for a_j, k in zip(a, ks)), u))
+            y = x + h * sum(b_j * k for b_j, k in zip(DP_B, ks))
+            k7 = self.derivative(y, u)
+            with torch.no_grad():
+                err = h * sum(e_j * k for e_j, k in zip(DP_E, ks + [k7]))
+                scale = self.atol + self.rtol * torch.maximum(torch.abs(x), torch.abs(y))
+                e = float(torch.sqrt(torch.mean((err / scale) ** 2, dim=-1)).max())
+
+            if e <= 1:
+                t += h
+                small = torch.abs(y) < 1e-12
+                if small.any():
+                    y = torch.where(small, torch.zeros_like(y), y)
+                    k7 = self.derivative(y, u)
+                x, k1 = y, k7
+            h = h * min(5., max(.2, .9 * e ** -.2)) if e > 0 else 5 * h
+            if not math.isfinite(h) or h < 1e-14 * T:
+                raise ValueError("Step size of the rk45 integrator underflowed, the state is not finite")
+        return x.to(dtype)
+
+    def predict_torch(self, X, U):
+        # change in state over one step, like the learned delta models
+        return self.forward(X, U) - X
+
+    def predict(self, X, U, ret_var=False):
+        X = torch.as_tensor(np.asarray(X, dtype=np.float64))
+        U = torch.as_tensor(np.asarray(U, dtype=np.float64))
+        with torch.no_grad():
+            return self.predict_torch(X, U).numpy()
@@ -20,7 +20,9 @@ sys.path.append(os.getcwd())
 
 from learn.control.pid import PID
 from learn.control.pid import PidPolicy
-from learn.utils.data import cwd_basedir
+from learn.utils.data import cwd_basedir, load_logs
+from learn.utils.columnar import sas_dataset, read_columns
+from learn.models.checkpoint import load_model
 from learn.utils.plotly import plot_rollout, generate_errorbar_traces
 from learn.utils.bo import plot_cost_itr, plot_parameters, PID_scalar
 
@@ -241,13 +243,19 @@ def optimizer(cfg):
 
     num_r = cfg.bo.rollouts
 
-    model = torch.load(cwd_basedir() + 'ex_data/models/' + cfg.env.params.name + '.dat')
-    trained_data = pd.read_csv(cwd_basedir() + 'ex_data/SAS/' + cfg.env.params.name + '.csv')
-
+    model = load_model(cwd_basedir() + 'ex_data/models/' + cfg.env.params.name + '.dat')
     states_in = model.state_list
     actions_in = model.input_list
     targets = model.change_state_list
 
+    sas = sas_dataset(cwd_basedir() + 'ex_data/SAS/', cfg.env.params.name)
+    if sas is not None:
+        # only the columns of the model, see learn.utils.columnar
+        trained_data = read_columns(sas, states_in + actions_in + targets)
+    else:
+        # preprocessed from the logs, through the dataset cache with load.cache
+        trained_data, _ = load_logs(cfg.robot, cfg.load.fname, cfg.load)
+
     s = trained_data[states_in].values
     a = trained_data[actions_in].values
     t = trained_data[targets].values
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pandas as pd
+import torch
+
+from learn.utils.data import cwd_basedir
+from learn.utils.columnar import sas_dataset, read_columns, read_meta
+from learn.models.checkpoint import load_model
+from learn.models.quantize import quantize_model, accuracy_report
+
+import logging
+import hydra
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path='conf/quantize.yaml')
+def quantize_report(cfg):
+    model = load_model(cwd_basedir() + 'ex_data/models/' + cfg.model + '.dat')
+    # the columns of the model and the terminals, see learn.utils.columnar
+    path = sas_dataset(cwd_basedir() + 'ex_data/SAS/', cfg.data)
+    columns = [c for lst in model.get_training_lists() for c in lst]
+    df = read_columns(path, columns + [c for c in ('term',) if c in read_meta(path)['columns']])
+    log.info(f"Model {cfg.model} on {len(df)} rows of {cfg.data}")
+
+    rows = []
+    for mode in cfg.modes:
+        reduced = quantize_model(model, mode=mode)
+        report = accuracy_report(model, reduced, df, horizons=list(cfg.horizons), batch=cfg.batch)
+        for key, row in report.items():
+            rows.append(dict(mode=mode, metric=key, **row))
+
+    table = pd.DataFrame(rows).set_index(['mode', 'metric'])
+    log.info(f"Normalized MSE against the log (float, reduced), between the models (divergence) and calls/s\n"
+             f"{table.to_string()}")
+    if cfg.save:
+        table.to_csv(os.path.join(os.getcwd(), 'quantize_report.csv'))
+
+
+if __name__ == '__main__':
+    sys.exit(quantize_report())
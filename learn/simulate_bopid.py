@@ -101,7 +101,7 @@ from learn.simulate_bopid import *
 @hydra.main(config_path='conf/bopid.yaml')
 def pid(cfg):
     env_name = cfg.env.params.name
-    env = gym.make(env_name)
+    env = envs.make_env(cfg.env.params)
     env.reset()
     full_rewards = []
     exp_cfg = cfg.experiment
@@ -452,6 +452,9 @@ def pid(cfg):
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
     # # # # # # # # # # # Evalutation Function  # # # # # # # # # # # # # # # # # # # #
+    # evaluations so far, each one's repeats get their own seeds
+    n_evals = [0]
+
     def bo_rollout_wrapper(params, weights=None):  # env, controller, exp_cfg):
         pid_1 = [params["pitch-p"], params["pitch-i"], params["pitch-d"]]
         # pid_1 = [params["roll-p"], params["roll-i"],
@@ -468,9 +471,12 @@ def pid(cfg):
         r = 0
         fncs = [squ_cost, living_reward, rotation_mat]
         mult_rewards = [[] for _ in range(len(fncs))]
-        while r < cfg.experiment.repeat:
-            pid.reset()
-            states, actions, rews, sim_error = rollout(env, pid, exp_cfg)
+        pid.reset()
+        # the repeats run as one batch, in experiment.workers processes
+        batch = rollout_batch(env, pid, exp_cfg, cfg.experiment.repeat, workers=cfg.experiment.get('workers', 0),
+                              seed=cfg.random_seed * 10 ** 6 + n_evals[0] * cfg.experiment.repeat)
+        n_evals[0] += 1
+        for states, actions, rews, sim_error in episodes(batch):
             # plot_rollout(states, actions, pry=[1, 0, 2])
             rewards_full = get_rewards(states, actions, fncs=fncs)
             for i, vec in enumerate(rewards_full):
@@ -10,6 +10,7 @@ import hydra
 import gym
 import torch
 import numpy as np
+from learn import envs
 from learn.envs.model_env import ModelEnv
 
 from learn.simulate_sac import SAC, ReplayBuffer, eval_mode, set_seed_everywhere, evaluate_policy
@@ -22,7 +23,7 @@ def mbpo_experiment(cfg):
     log.info(f"Config:\n{cfg.pretty()}")
     log.info("=========================================")
 
-    real_env = gym.make(cfg.env.params.name)
+    real_env = envs.make_env(cfg.env.params)
 
     if cfg.metric.name == 'Living':
         metric = living_reward
@@ -37,7 +37,7 @@ def mpc(cfg):
     log.info("=========================================")
 
     env_name = cfg.env.params.name
-    env = gym.make(env_name)
+    env = envs.make_env(cfg.env.params)
     env.reset()
     full_rewards = []
 
@@ -57,23 +57,32 @@ def mpc(cfg):
         total_costs = []
         data_rand = []
         total_steps = []
+        # every episode gets its own seed, the rollouts of a batch run in experiment.workers processes
+        episode_seed = [cfg.random_seed * 10 ** 6 + s * 10 ** 4]
+
+        def run_batch(controller, n):
+            batch = rollout_batch(env, controller, cfg.experiment, n, metric=metric, seed=episode_seed[0],
+                                  workers=cfg.experiment.get('workers', 0))
+            episode_seed[0] += n
+            return episodes(batch)
+
         r = 0
         while r < cfg.experiment.random:
-            data_r = rollout(env, RandomController(env, cfg), cfg.experiment, metric=metric)
-            plot_rollout(data_r[0], data_r[1], pry=cfg.pid.params.pry, save=cfg.save, loc=f"/R_{r}")
-            rews = data_r[-2]
-            sim_error = data_r[-1]
-            if sim_error:
-                print("Repeating strange simulation")
-                continue
-            # rand_costs.append(np.sum(rews) / len(rews))  # for minimization
-            total_costs.append(np.sum(rews))  # for minimization
-            # log.info(f" - Cost {np.sum(rews) / cfg.experiment.r_len}")
-            r += 1
-
-            # data_sample = subsample(data_r, cfg.policy.params.period)
-            data_rand.append(data_r)
-            total_steps.append(0)
+            for data_r in run_batch(RandomController(env, cfg), cfg.experiment.random - r):
+                plot_rollout(data_r[0], data_r[1], pry=cfg.pid.params.pry, save=cfg.save, loc=f"/R_{r}")
+                rews = data_r[-2]
+                sim_error = data_r[-1]
+                if sim_error:
+                    print("Repeating strange simulation")
+                    continue
+                # rand_costs.append(np.sum(rews) / len(rews))  # for minimization
+                total_costs.append(np.sum(rews))  # for minimization
+                # log.info(f" - Cost {np.sum(rews) / cfg.experiment.r_len}")
+                r += 1
+
+                # data_sample = subsample(data_r, cfg.policy.params.period)
+                data_rand.append(data_r)
+                total_steps.append(0)
 
         X, dX, U = to_XUdX(data_r)
         X, dX, U = combine_data(data_rand[:-1], (X, dX, U))
@@ -97,28 +106,29 @@ def mpc(cfg):
         model, train_log = train_model(X, U, dX, cfg.model)
 
         for i in range(cfg.experiment.num_roll-cfg.experiment.random):
-            controller = MPController(env, model, cfg)
+            # the distilled student is much cheaper to query than the ensemble, if one was trained
+            controller = MPController(env, train_log.get('student', model), cfg)
 
             r = 0
             cum_costs = []
             data_rs = []
             while r < cfg.experiment.repeat:
-                data_r = rollout(env, controller, cfg.experiment, metric=metric)
-                plot_rollout(data_r[0], data_r[1], pry=cfg.pid.params.pry, save=cfg.save, loc=f"/{str(i)}_{r}")
-                rews = data_r[-2]
-                sim_error = data_r[-1]
-
-                if sim_error:
-                    print("Repeating strange simulation")
-                    continue
-                # cum_costs.append(np.sum(rews) / len(rews))  # for minimization
-                total_costs.append(np.sum(rews))  # for minimization
-                # log.info(f" - Cost {np.sum(rews) / cfg.experiment.r_len}")
-                r += 1
-
-                # data_sample = subsample(data_r, cfg.policy.params.period)
-                data_rs.append(data_r)
-                total_steps.append(np.shape(X)[0])
+                for data_r in run_batch(controller, cfg.experiment.repeat - r):
+                    plot_rollout(data_r[0], data_r[1], pry=cfg.pid.params.pry, save=cfg.save, loc=f"/{str(i)}_{r}")
+                    rews = data_r[-2]
+                    sim_error = data_r[-1]
+
+                    if sim_error:
+                        print("Repeating strange simulation")
+                        continue
+                    # cum_costs.append(np.sum(rews) / len(rews))  # for minimization
+                    total_costs.append(np.sum(rews))  # for minimization
+                    # log.info(f" - Cost {np.sum(rews) / cfg.experiment.r_len}")
+                    r += 1
+
+                    # data_sample = subsample(data_r, cfg.policy.params.period)
+                    data_rs.append(data_r)
+                    total_steps.append(np.shape(X)[0])
 
             X, dX, U = combine_data(data_rs, (X, dX, U))
             msg = "Rollouts completed of "
@@ -138,7 +148,7 @@ def mpc(cfg):
             )
             save_log(cfg, i, trial_log)
 
-            model, train_log = train_model(X, U, dX, cfg.model)
+            model, train_log = train_model(X, U, dX, cfg.model, model=model)
 
         fig = plot_rewards_over_trials(np.transpose(np.stack([total_costs])), env_name, save=True)
         fig.write_image(os.getcwd() + "/learning-curve.pdf")
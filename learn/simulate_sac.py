@@ -472,7 +472,7 @@ def sac_experiment(cfg):
     log.info(f"Config:\n{cfg.pretty()}")
     log.info("=========================================")
 
-    real_env = gym.make(cfg.env.params.name)
+    real_env = envs.make_env(cfg.env.params)
     set_seed_everywhere(cfg.random_seed)
 
     obs_dim = cfg.model.params.dx
@@ -534,7 +534,7 @@ def sac_experiment(cfg):
     to_plot_rewards.append(rewards)
     total_steps.append(0)
 
-    env = gym.make(cfg.env.params.name)
+    env = envs.make_env(cfg.env.params)
 
     # from gym import spaces
     # env.action_space = spaces.Box(low=np.array([0, 0, 0, 0]),
@@ -8,12 +8,16 @@ sys.path.append(os.getcwd())
 # from utils_nn import *
 from learn.utils.data import *
 from learn.utils.nn import *
+from learn.utils.columnar import sas_dataset, read_columns, read_meta, model_columns
+from learn.utils.stream import MemmapDataset
 import learn.utils.matplotlib as u_p
 from learn.utils.plotly import plot_test_train, plot_dist
 # neural nets
 from learn.models.model_general_nn import GeneralNN
 from learn.models.model_ensemble_nn import EnsembleNN
 from learn.models.linear_model import LinearModel
+from learn.models.export import export_model
+from learn.models.distill import distill
 
 # Torch Packages
 import torch
@@ -93,34 +97,63 @@ def params_to_training(data):
     return X, U, dX
 
 
-def train_model(X, U, dX, model_cfg, logged=False):
-    if logged: log.info(f"Training Model on {np.shape(X)[0]} pts")
+def train_model(X, U, dX, model_cfg, logged=False, model=None, lists=None):
+    """
+    Trains a new model on X, U, dX. With training.incremental and the previous model passed as model, that model
+    is fine tuned on the data added since it was trained instead (X, U, dX must extend its old training data).
+    lists are the (state, input, target) column labels stored on the model. With distill.student an ensemble is
+    also distilled into a single network for the controller, returned as train_log['student'].
+    X can also be an out of core learn.utils.stream.MemmapDataset (U and dX are None then), which is trained on
+    as is: no clustering, incremental training or distillation.
+    """
+    stream = hasattr(X, 'batches')
+    if logged: log.info(f"Training Model on {len(X)} pts")
     start = time.time()
     train_log = dict()
 
     train_log['model_params'] = model_cfg.params
-    model = hydra.utils.instantiate(model_cfg)
-
-    if model_cfg.params.training.cluster > 0:
-        h = model_cfg.params.history
-        mat = to_matrix(X, U, dX, model_cfg)
-        num_pts = np.shape(mat)[0]
-        if num_pts < model_cfg.params.training.cluster:
-            if logged: log.info(f"Not enough points to cluster to {model_cfg.params.training.cluster} yet.")
+    if model is not None and model_cfg.params.training.get('incremental', False) and not stream:
+        acctest, acctrain = model.train_incremental((X, U, dX), model_cfg.params)
+    else:
+        model = hydra.utils.instantiate(model_cfg)
+
+        if model_cfg.params.training.cluster > 0 and not stream:
+            h = model_cfg.params.history
+            mat = to_matrix(X, U, dX, model_cfg)
+            num_pts = np.shape(mat)[0]
+            if num_pts < model_cfg.params.training.cluster:
+                if logged: log.info(f"Not enough points to cluster to {model_cfg.params.training.cluster} yet.")
+                X_t = X
+                U_t = U
+                dX_t = dX
+            else:
+                mat_r = cluster(mat, model_cfg.params.training.cluster)
+                X_t, U_t, dX_t = to_Dataset(mat_r, dims=[model_cfg.params.dx * (h + 1),
+                                                         model_cfg.params.du * (h + 1),
+                                                         model_cfg.params.dt])
+        else:
             X_t = X
             U_t = U
             dX_t = dX
-        else:
-            mat_r = cluster(mat, model_cfg.params.training.cluster)
-            X_t, U_t, dX_t = to_Dataset(mat_r, dims=[model_cfg.params.dx * (h + 1), model_cfg.params.du * (h + 1),
-                                                 model_cfg.params.dt])
-    else:
-        X_t = X
-        U_t = U
-        dX_t = dX
 
-    acctest, acctrain = model.train_cust((X_t, U_t, dX_t), model_cfg.params)
+        acctest, acctrain = model.train_cust((X_t, U_t, dX_t), model_cfg.params)
+
+    if lists is not None:
+        model.store_training_lists(*lists)
+    train_log = log_errors(train_log, acctest, acctrain, model_cfg, start, logged)
+
+    distill_cfg = model_cfg.params.get('distill', None)
+    if getattr(model, 'E', 0) and distill_cfg is not None and distill_cfg.get('student', False) and not stream:
+        start = time.time()
+        student, testerror, trainerror = distill(model, X, U, model_cfg.params)
+        train_log['student'] = student
+        train_log['student_testerror'] = testerror
+        train_log['student_trainerror'] = trainerror
+        if logged: log.info(f"Distilled a student in {time.time() - start} s, min test error {np.min(testerror)}")
+    return model, train_log
+
 
+def log_errors(train_log, acctest, acctrain, model_cfg, start, logged=False):
     if model_cfg.params.training.ensemble:
         min_err = np.min(acctrain, 0)
         min_err_test = np.min(acctest, 0)
@@ -135,7 +168,7 @@ def train_model(X, U, dX, model_cfg, logged=False):
 
     end = time.time()
     if logged: log.info(f"Trained Model in {end-start} s")
-    return model, train_log
+    return train_log
 
 
 ######################################################################
@@ -150,68 +183,80 @@ def trainer(cfg):
 
     data_dir = cfg.load.fname  # base_dir
 
-    avail_data = os.path.join(os.getcwd()[:os.getcwd().rfind('outputs') - 1] + f"/ex_data/SAS/{cfg.robot}.csv")
-    if os.path.isfile(avail_data):
-        df = pd.read_csv(avail_data)
-        log.info(f"Loaded preprocessed data from {avail_data}")
+    avail_data = sas_dataset(os.path.join(cwd_basedir(), 'ex_data', 'SAS'), cfg.robot)
+    stream = avail_data is not None and cfg.load.get('stream', False)
+    if stream:
+        # out of core, the model trains from the memory mapped columns, see learn.utils.stream. The lists come from
+        #   the schema, so no rows are loaded and the outlier filter is skipped
+        columns = model_columns(read_meta(avail_data)['schema'], cfg.model.params)
+        data = create_model_params(pd.DataFrame(columns=columns), cfg.model)
+        X = MemmapDataset(avail_data, data['states'].columns, data['inputs'].columns, data['targets'].columns,
+                          chunk=cfg.load.get('chunk', 65536), prefetch=cfg.load.get('prefetch', 2))
+        U, dX = None, None
+        log.info(f"Streaming {len(X)} rows from {avail_data}")
     else:
-        if cfg.robot == 'iono':
-            df, log_load = preprocess_iono(data_dir, cfg.load)
+        if avail_data is not None:
+            # only the columns the model uses, see learn.utils.columnar
+            df = read_columns(avail_data, model_columns(read_meta(avail_data)['schema'], cfg.model.params))
+            log.info(f"Loaded preprocessed data from {avail_data}")
         else:
-            df, log_load = preprocess_cf(data_dir, cfg.load)
-        msg = f"Loading Data"
-        if 'dir' in log_load is not None:
-            msg += f", dir={log_load['dir']}"
-        if 'num_files' in log_load is not None:
-            msg += f", num_files={log_load['num_files']}"
-        if 'datapoints' in log_load:
-            msg += f", datapoints={log_load['datapoints']}"
-        log.info(msg)
-
-    from scipy import stats
-    # remove data 4 standard deviations away
-    df = df[(np.nan_to_num(np.abs(stats.zscore(df))) < 4).all(axis=1)]
-    # plot_dist(df, x='roll_0tx', y='pitch_0tx', z='yaw_0tx')
-    data = create_model_params(df, cfg.model)
-    X = data['states'].values
-    U = data['inputs'].values
-    dX = data['targets'].values
-
-    # x = torch.Tensor(np.hstack((X,U,dX))).numpy()
-    # import faiss
-    # # x = vectorized
-    # niter = 50
-    # ncentroids = 500
-    # verbose = True
-    # d = x.shape[1]
-    # kmeans = faiss.Kmeans(d, ncentroids, niter=niter, verbose=verbose)
-    # kmeans.train(x)
-    #
-    # # for i, v in enumerate(kmeans.centroids):
-    # #     print(i)
-    #
-    # index = faiss.IndexFlatL2(d)
-    # index.add(x)
-    # D, I = index.search(kmeans.centroids, 1)
-    # x_reduced = x[I, :].squeeze()
-    # df.iloc[I.squeeze()]
-    # plot_dist(df, x='roll_0tx', y='pitch_0tx', z='yaw_0tx')
-    #
-    # quit()
-
-
-
-
-    data = create_model_params(df, cfg.model)
-
-    X, U, dX = params_to_training(data)
-
-    model, train_log = train_model(X, U, dX, cfg.model)
-    model.store_training_lists(list(data['states'].columns),
-                               list(data['inputs'].columns),
-                               list(data['targets'].columns))
-
-    mse = plot_test_train(model, (X, U, dX), variances=True)
+            # through the dataset cache with load.cache, see learn.utils.cache
+            df, log_load = load_logs(cfg.robot, data_dir, cfg.load)
+            msg = f"Loading Data"
+            if 'dir' in log_load is not None:
+                msg += f", dir={log_load['dir']}"
+            if 'num_files' in log_load is not None:
+                msg += f", num_files={log_load['num_files']}"
+            if 'datapoints' in log_load:
+                msg += f", datapoints={log_load['datapoints']}"
+            if 'cache' in log_load:
+                msg += f", cached in {log_load['cache']}"
+            log.info(msg)
+
+        from scipy import stats
+        # remove data 4 standard deviations away
+        df = df[(np.nan_to_num(np.abs(stats.zscore(df))) < 4).all(axis=1)]
+        # plot_dist(df, x='roll_0tx', y='pitch_0tx', z='yaw_0tx')
+        data = create_model_params(df, cfg.model)
+        X = data['states'].values
+        U = data['inputs'].values
+        dX = data['targets'].values
+
+        # x = torch.Tensor(np.hstack((X,U,dX))).numpy()
+        # import faiss
+        # # x = vectorized
+        # niter = 50
+        # ncentroids = 500
+        # verbose = True
+        # d = x.shape[1]
+        # kmeans = faiss.Kmeans(d, ncentroids, niter=niter, verbose=verbose)
+        # kmeans.train(x)
+        #
+        # # for i, v in enumerate(kmeans.centroids):
+        # #     print(i)
+        #
+        # index = faiss.IndexFlatL2(d)
+        # index.add(x)
+        # D, I = index.search(kmeans.centroids, 1)
+        # x_reduced = x[I, :].squeeze()
+        # df.iloc[I.squeeze()]
+        # plot_dist(df, x='roll_0tx', y='pitch_0tx', z='yaw_0tx')
+        #
+        # quit()
+
+
+
+
+        data = create_model_params(df, cfg.model)
+
+        X, U, dX = params_to_training(data)
+
+    model, train_log = train_model(X, U, dX, cfg.model, lists=(list(data['states'].columns),
+                                                               list(data['inputs'].columns),
+                                                               list(data['targets'].columns)))
+
+    # a stream is plotted on its first chunk
+    mse = plot_test_train(model, next(X.chunks()) if stream else (X, U, dX), variances=True)
     torch.save((mse, cfg.model.params.training.cluster), 'cluster.dat')
 
     log.info(f"MSE of test set predictions {mse}")
@@ -236,13 +281,23 @@ def trainer(cfg):
 
     # Saves NN params
     if cfg.save:
-        save_file(model, cfg.model.params.name + '.pth')
-
-        normX, normU, normdX = model.getNormScalers()
-        save_file((normX, normU, normdX), cfg.model.params.name + "_normparams.pkl")
-
-        # Saves data file
-        save_file(data, cfg.model.params.name + "_data.pkl")
+        # the checkpoint holds the scaler statistics too, see learn.models.checkpoint
+        log.info(f"Saving File: {cfg.model.params.name + '.pth'}")
+        model.save_model(os.path.join(os.getcwd(), cfg.model.params.name + '.pth'))
+        if cfg.get('export', False):
+            # traced inference graph for the controllers, see learn.control.inference
+            log.info(f"Saving File: {cfg.model.params.name + '.ts'}")
+            export_model(model, os.path.join(os.getcwd(), cfg.model.params.name + '.ts'))
+        if 'student' in train_log:
+            log.info(f"Saving File: {cfg.model.params.name + '_student.pth'}")
+            train_log['student'].save_model(os.path.join(os.getcwd(), cfg.model.params.name + '_student.pth'))
+            if cfg.get('export', False):
+                export_model(train_log['student'],
+                             os.path.join(os.getcwd(), cfg.model.params.name + '_student.ts'))
+
+        # Saves data file, a stream is on disk already
+        if not stream:
+            save_file(data, cfg.model.params.name + "_data.pkl")
 
     log.info(f"Saved to directory {os.getcwd()}")
 
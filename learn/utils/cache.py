@@ -0,0 +1,79 @@
+"""
+On disk cache of the preprocessed flight logs, the dataframes of preprocess_cf / preprocess_iono. An entry is keyed by
+the sha1 of the raw log files (names and contents, in load order) and of the load parameters they were processed
+with, so editing a log or changing a setting misses the cache instead of returning old data. Each entry is a directory
+in the columnar format of learn.utils.columnar, with the load log in its meta.json, which loads without any parsing.
+Writing an entry prunes the entries made from the same logs before their files changed.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+from omegaconf import DictConfig, OmegaConf
+
+from .columnar import write_columns, read_columns, read_meta, is_dataset, locked
+
+# load parameters that change how the logs are read but not the resulting dataframe
+IGNORED_PARAMS = ('workers', 'cache', 'cache_dir', 'stream', 'chunk', 'prefetch')
+
+
+def files_digest(files):
+    h = hashlib.sha1()
+    for f in files:
+        h.update(os.path.basename(f).encode())
+        with open(f, 'rb') as fi:
+            for chunk in iter(lambda: fi.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def params_digest(name, load_params):
+    if isinstance(load_params, DictConfig):
+        load_params = OmegaConf.to_container(load_params, resolve=True)
+    params = {k: v for k, v in dict(load_params).items() if k not in IGNORED_PARAMS}
+    return hashlib.sha1(json.dumps([name, params], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def prune(cache_dir, keep, meta):
+    """
+    Removes the entries from the same source and loader as meta that were made from other file contents
+    """
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if key == keep or not is_dataset(path):
+            continue
+        old = read_meta(path)
+        if old.get('source') == meta['source'] and old.get('loader') == meta['loader'] and \
+                old.get('files') != meta['files']:
+            shutil.rmtree(path, ignore_errors=True)
+            if os.path.isfile(f"{path}.lock"):
+                os.remove(f"{path}.lock")
+
+
+def cached(preprocess, files, dir, load_params, cache_dir):
+    """
+    preprocess(dir, load_params) for the logs files, from the cache in cache_dir when an entry for the same files and
+    load parameters exists. Returns the dataframe and load log like preprocess.
+    """
+    meta = dict(loader=preprocess.__name__, source=str(load_params.get('fname', dir)),
+                files=files_digest(files), params=params_digest(preprocess.__name__, load_params))
+    key = hashlib.sha1((meta['files'] + meta['params']).encode()).hexdigest()
+    path = os.path.join(cache_dir, key)
+
+    def hit():
+        df = read_columns(path)
+        load_log = read_meta(path)['load_log']
+        load_log['cache'] = path
+        return df, load_log
+
+    if is_dataset(path):
+        return hit()
+    with locked(path):
+        # runs started together wait here for the first one to write the entry
+        if is_dataset(path):
+            return hit()
+        df, load_log = preprocess(dir, load_params)
+        write_columns(path, df, dict(meta, load_log=load_log))
+    prune(cache_dir, key, meta)
+    return df, load_log
@@ -0,0 +1,145 @@
+"""
+Binary columnar storage of the SAS dataframes (ex_data/SAS and the dataset cache of learn.utils.cache). A dataset is a
+directory with one .npy file per column and a meta.json with the column names and a schema of the column groups:
+ - states: <var>_<k>tx, the state k steps back
+ - inputs: <var>_<k>tu, the input k steps back
+ - targets: <var>_0dx changes of state and <var>_1fx next states
+ - other: everything else (time stamps, objective values, terminals, battery)
+and the history depth, the largest k of the states and inputs. Readers load only the columns asked for, so training a
+model with a short history doesn't read the stacked columns it drops.
+Datasets are written under a lock file next to them (path.lock), so parallel runs (eg. a hydra multirun) convert a
+csv once and never remove a dataset another run is reading.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+GROUPS = {'tx': 'states', 'tu': 'inputs', 'dx': 'targets', 'fx': 'targets'}
+
+
+def column_schema(columns):
+    schema = dict(states=[], inputs=[], targets=[], other=[], history=0)
+    for c in columns:
+        m = re.fullmatch(r'(.+)_(\d+)(tx|tu|dx|fx)', str(c))
+        if m is None:
+            schema['other'].append(str(c))
+            continue
+        schema[GROUPS[m.group(3)]].append(str(c))
+        if m.group(3) in ('tx', 'tu'):
+            schema['history'] = max(schema['history'], int(m.group(2)))
+    return schema
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Holds the lock of the dataset path, across processes, while the block runs. Writers take it and check again
+    whether the dataset still needs writing once they have it.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_columns(path, df, meta=None):
+    """
+    Writes df to the directory path, replacing what is there, with meta added to its meta.json. Call it holding
+    locked(path) when other processes may write the same dataset.
+    """
+    # written next to path and renamed into place, so readers never see half a dataset
+    tmp = f"{path}.tmp{os.getpid()}"
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for i, c in enumerate(df.columns):
+        np.save(os.path.join(tmp, f"{i}.npy"), np.ascontiguousarray(df[c].values), allow_pickle=False)
+    meta = dict(meta or {}, columns=[str(c) for c in df.columns], rows=len(df), schema=column_schema(df.columns))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, default=str)
+    # the old dataset is renamed out of the way before it is removed, its files stay valid for readers that have
+    #   them open or memory mapped
+    old = f"{path}.old{os.getpid()}"
+    if os.path.isdir(path):
+        os.replace(path, old)
+    os.replace(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def is_dataset(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def read_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+def read_columns(path, columns=None, mmap_mode=None):
+    """
+    Dataframe of the columns (all by default, in stored order either way) of the dataset in path. With mmap_mode
+    the columns are memory mapped by np.load rather than read.
+    """
+    meta = read_meta(path)
+    index = {c: i for i, c in enumerate(meta['columns'])}
+    if columns is None:
+        columns = meta['columns']
+    else:
+        missing = [c for c in columns if c not in index]
+        if missing:
+            raise KeyError(f"Columns not in {path}: {missing}")
+        wanted = set(columns)
+        columns = [c for c in meta['columns'] if c in wanted]
+    return pd.DataFrame({c: np.load(os.path.join(path, f"{index[c]}.npy"), mmap_mode=mmap_mode) for c in columns},
+                        columns=columns)
+
+
+def model_columns(schema, params):
+    """
+    Columns of a dataset with schema that create_model_params in the trainer uses for the model params: the states
+    and inputs up to params.history steps back (minus params.ignore_in), the extra inputs and the targets
+    """
+    def k(c):
+        return int(c.rsplit('_', 1)[1][:-2])
+
+    ignore = params.get('ignore_in', None) or []
+    states = [c for c in schema['states'] if k(c) <= params.history and not any(i in c for i in ignore)]
+    inputs = [c for c in schema['inputs'] if k(c) <= params.history]
+    extra = [c for c in schema['states'] + schema['inputs'] + schema['targets'] + schema['other']
+             if any(re.search(e, c) for e in (params.get('extra_inputs', None) or []))]
+
+    targets = []
+    for typ in params.delta_state_targets or []:
+        targets.append(typ + '_0dx')
+    for typ in params.true_state_targets or []:
+        targets.append(typ + '_1fx')
+    return states + inputs + extra + targets
+
+
+def sas_dataset(base, name):
+    """
+    Path of the SAS dataset name in the directory base (eg. ex_data/SAS/), or None if there is none. A name.csv there
+    is converted to the dataset base/name on the first read, and again whenever the csv is newer.
+    """
+    path = os.path.join(base, name)
+    csv = path + '.csv'
+
+    def stale():
+        return not is_dataset(path) or os.path.getmtime(csv) > read_meta(path).get('csv_mtime', 0)
+
+    if os.path.isfile(csv) and stale():
+        with locked(path):
+            # another run may have converted it while this one waited for the lock
+            if stale():
+                mtime = os.path.getmtime(csv)
+                write_columns(path, pd.read_csv(csv), dict(csv_mtime=mtime))
+    return path if is_dataset(path) else None
@@ -17,14 +17,74 @@ import torch
 def cwd_basedir():
     return os.getcwd()[:os.getcwd().rfind('outputs')]
 
-def preprocess_cf(dir, load_params):
-    '''
-    Takes in a directory and returns a dataframe for the data
-    '''
 
-    load_log = dict()
+# names of the stacked history columns <name>_<k>tx / <name>_<k>tu of the loaders' dataframes
+HISTORY_STATES = ['omegax', 'omegay', 'omegaz', 'pitch', 'roll', 'yaw', 'linax', 'linay', 'linaz']
+HISTORY_INPUTS = ['m1pwm', 'm2pwm', 'm3pwm', 'm4pwm']
+
+
+def stack_history(data, k):
+    """
+    Stacks the last k rows of the [n x d] data, newest first: row i of the [n-k+1 x k*d] result is data[i+k-1],
+    data[i+k-2], ..., data[i]. The windows are a strided view of data, the only copy is into the flat layout.
+    """
+    n, d = np.shape(data)
+    m = max(n - k + 1, 0)
+    s0, s1 = data.strides
+    windows = np.lib.stride_tricks.as_strided(data, shape=(m, k, d), strides=(s0, s0, s1), writeable=False)
+    return windows[:, ::-1, :].reshape(m, k * d)
+
+
+def history_columns(X, names, offsets, k, suffix):
+    """
+    Dataframe columns <name>_<j><suffix> for j = 1..k of the stacked X, where name is in column offset + (j-1)*d of
+    X (d = len(names)). Ordered by j, then as names.
+    """
+    idx = (np.arange(k)[:, None] * len(names) + np.asarray(list(offsets))[None, :]).ravel()
+    keys = [f"{name}_{j + 1}{suffix}" for j in range(k) for name in names]
+    return dict(zip(keys, X[:, idx].T))
+
+
+def map_files(fnc, args, workers=0):
+    """
+    [fnc(a) for a in args], in a pool of workers processes if workers > 0. The order of the results is kept.
+    """
+    if workers > 0 and len(args) > 1:
+        import multiprocessing as mp
+        with mp.get_context('spawn').Pool(min(workers, len(args))) as pool:
+            return pool.map(fnc, args)
+    return [fnc(a) for a in args]
+
+
+def _load_cf_flight(args):
+    """
+    Loads one flight for preprocess_cf: the arrays of trim_load_param, cut by one point when the next states are
+    included (then also returned, otherwise None)
+    """
+    f, load_params = args
+    X_t, U_t, dX_t, objv_t, Ts_t, time, terminal = trim_load_param(f, load_params)
+
+    # shortens length by one point
+    tplus1 = None
+    if load_params['include_tplus1']:
+        tplus1 = X_t[1:, :]
+
+        X_t = X_t[:-1, :]
+        U_t = U_t[:-1, :]
+        dX_t = dX_t[:-1, :]
+        objv_t = objv_t[:-1]
+        Ts_t = Ts_t[:-1]
+        time = time[:-1]
+        terminal = terminal[:-1]
+        terminal[-1] = 1
+    return X_t, U_t, dX_t, objv_t, Ts_t, time, terminal, tplus1
 
 
+def cf_files(load_params):
+    """
+    The crazyflie logs to load: the files in the subdirectories of load_params.fname with load_params.freq in their
+    name, or the list of files in load_params.fname
+    """
     if load_params.dir:
         files = []
         dirs = os.listdir(
@@ -40,85 +100,35 @@ def preprocess_cf(dir, load_params):
             files += dir_files_full
     else:
         files = load_params.fname
+    return files
 
-    load_log['dir'] = load_params.fname
-    load_log['num'] = len(files)
-
-    # init arrays
-    X = []
-    U = []
-    dX = []
-    objv = []
-    Ts = []
-    times = []
-    terminals = []
-
-    # init if needed. This will play with terminals a little bit
-    if load_params['include_tplus1']:
-        tplus1 = []
-
-    for f in files:
-        # print(f)
-        if len(f) > 5 and f[-4:] == '.csv':
-            X_t, U_t, dX_t, objv_t, Ts_t, time, terminal = trim_load_param(f, load_params)
-
-            # shortens length by one point
-            if load_params['include_tplus1']:
-                if times == []:
-                    tplus1 = X_t[1:, :]
-                else:
-                    tplus1 = np.append(tplus1, X_t[1:, :], axis=0)
-
-                X_t = X_t[:-1, :]
-                U_t = U_t[:-1, :]
-                dX_t = dX_t[:-1, :]
-                objv_t = objv_t[:-1]
-                Ts_t = Ts_t[:-1]
-                time = time[:-1]
-                terminal = terminal[:-1]
-                terminal[-1] = 1
-
-            # global time (ROS time)
-            if times == []:
-                times = time
-            else:
-                times = np.append(times, time)
-
-            # State data
-            if X == []:
-                X = X_t
-            else:
-                X = np.append(X, X_t, axis=0)
 
-            # inputs
-            if U == []:
-                U = U_t
-            else:
-                U = np.append(U, U_t, axis=0)
+def preprocess_cf(dir, load_params):
+    '''
+    Takes in a directory and returns a dataframe for the data
+    '''
 
-            # change in state
-            if dX == []:
-                dX = dX_t
-            else:
-                dX = np.append(dX, dX_t, axis=0)
+    load_log = dict()
 
-            # time step
-            if Ts_t == []:
-                Ts = Ts_t
-            else:
-                Ts = np.append(Ts, Ts_t, axis=0)
+    files = cf_files(load_params)
 
-            # objective value
-            if objv_t == []:
-                objv = objv_t
-            else:
-                objv = np.append(objv, objv_t, axis=0)
+    load_log['dir'] = load_params.fname
+    load_log['num'] = len(files)
 
-            # end of trajectory marker
-            if terminals == []:
-                terminals = terminal
-            else:
-                terminals = np.append(terminals, terminal, axis=0)
+    # each flight is parsed on its own (in load_params.workers processes if set) and the per flight arrays are
+    #   concatenated once at the end, rather than growing the dataset file by file
+    files = [f for f in files if len(f) > 5 and f[-4:] == '.csv']
+    flights = map_files(_load_cf_flight, [(f, load_params) for f in files], load_params.get('workers', 0))
+
+    X = np.concatenate([fl[0] for fl in flights], axis=0)
+    U = np.concatenate([fl[1] for fl in flights], axis=0)
+    dX = np.concatenate([fl[2] for fl in flights], axis=0)
+    objv = np.concatenate([fl[3] for fl in flights], axis=0)
+    Ts = np.concatenate([fl[4] for fl in flights], axis=0)
+    times = np.concatenate([fl[5] for fl in flights], axis=0)
+    terminals = np.concatenate([fl[6] for fl in flights], axis=0)
+    if load_params['include_tplus1']:
+        tplus1 = np.concatenate([fl[7] for fl in flights], axis=0)
 
     print('...has additional trimmed datapoints: ', np.shape(X)[0])
 
@@ -127,9 +137,6 @@ def preprocess_cf(dir, load_params):
 
     stack_states = load_params.stack_states
     if stack_states > 0:
-        state_idxs = np.arange(0, 9 * stack_states, 9)
-        input_idxs = np.arange(0, 4 * stack_states, 4)
-
         d = {'omegax' + '_0tx': X[:, 0],
              'omegay' + '_0tx': X[:, 1],
              'omegaz' + '_0tx': X[:, 2],
@@ -159,28 +166,8 @@ def preprocess_cf(dir, load_params):
              'flight times': times[:]
              }
 
-        k = 1
-        for i in state_idxs:
-            st = str(k)
-            k += 1
-            d['omegax_' + st + 'tx'] = X[:, 0 + i]
-            d['omegay_' + st + 'tx'] = X[:, 1 + i]
-            d['omegaz_' + st + 'tx'] = X[:, 2 + i]
-            d['pitch_' + st + 'tx'] = X[:, 3 + i]
-            d['roll_' + st + 'tx'] = X[:, 4 + i]
-            d['yaw_' + st + 'tx'] = X[:, 5 + i]
-            d['linax_' + st + 'tx'] = X[:, 6 + i]
-            d['linay_' + st + 'tx'] = X[:, 7 + i]
-            d['linaz_' + st + 'tx'] = X[:, 8 + i]
-
-        k = 1
-        for j in input_idxs:
-            st = str(k)
-            k += 1
-            d['m1pwm_' + st + 'tu'] = U[:, 0 + j]
-            d['m2pwm_' + st + 'tu'] = U[:, 1 + j]
-            d['m3pwm_' + st + 'tu'] = U[:, 2 + j]
-            d['m4pwm_' + st + 'tu'] = U[:, 3 + j]
+        d.update(history_columns(X, HISTORY_STATES, range(9), stack_states, 'tx'))
+        d.update(history_columns(U, HISTORY_INPUTS, range(4), stack_states, 'tu'))
 
     else:  # standard
         d = {'omegax' + '_0tx': X[:, 0],
@@ -320,13 +307,9 @@ def trim_load_param(fname, load_params):
         ###########################################################################
         # adding to make the input horizontally stacked set of inputs, rather than only the last input because of spinup time
         if input_stack > 1:
-            n, du = np.shape(new_data[:, 9:13])
             _, dx = np.shape(new_data[:, :9])
-            U = np.zeros((n - input_stack + 1, du * input_stack))
-            X = np.zeros((n - input_stack + 1, dx * input_stack))
-            for i in range(input_stack, n + 1, 1):
-                U[i - input_stack, :] = np.flip(new_data[i - input_stack:i, 9:13], axis=0).reshape(1, -1)
-                X[i - input_stack, :] = np.flip(new_data[i - input_stack:i, :9], axis=0).reshape(1, -1)
+            U = stack_history(new_data[:, 9:13], input_stack)
+            X = stack_history(new_data[:, :9], input_stack)
 
             if delta_state:
                 # Starts after the data that has requesit U values
@@ -656,66 +639,69 @@ def load_dirs(dir_list, load_params):
     return df
 
 
-def preprocess_iono(dir, load_params):
-    '''
-    Takes in a directory and returns a dataframe for the data, specifically for ionocraft data
-    '''
-
-    load_log = dict()
-
+def iono_files(dir, load_params):
+    # the ionocraft logs to load, the files in dir or the file load_params.fname in it
     if load_params.dir:
         files = os.listdir(
             load_params.fname)
     else:
         files = [load_params.fname]
+    return [dir + f for f in files if f[:3] != '.DS']
 
-    load_log['dir'] = load_params.fname
-    load_log['num_files'] = len(files)
 
-    # init arrays
-    X = []
-    U = []
-    dX = []
+def load_logs(robot, dir, load_params):
+    """
+    Dataframe and load log of the logs of robot (preprocess_iono or preprocess_cf). With load_params.cache the
+    dataframe is kept in the dataset cache of learn.utils.cache, in load_params.cache_dir or ex_data/cache/.
+    """
+    if robot == 'iono':
+        preprocess, files = preprocess_iono, iono_files(dir, load_params)
+    else:
+        preprocess = preprocess_cf
+        files = [f for f in cf_files(load_params) if len(f) > 5 and f[-4:] == '.csv']
+    if not load_params.get('cache', False):
+        return preprocess(dir, load_params)
 
-    terminals = []
+    from .cache import cached
+    cache_dir = load_params.get('cache_dir', '') or os.path.join(cwd_basedir(), 'ex_data', 'cache')
+    return cached(preprocess, files, dir, load_params, cache_dir)
 
-    # init if needed. This will play with terminals a little bit
+
+def _load_iono_flight(args):
+    # one file of preprocess_iono, cut by one point when the next states are included (then also returned)
+    f, load_params = args
+    X_t, U_t, dX_t = load_iono_txt(f, load_params)
+
+    # shortens length by one point
+    tplus1 = None
     if load_params.include_tplus1:
-        tplus1 = []
+        tplus1 = X_t[1:, :]
+        X_t = X_t[:-1, :]
+        U_t = U_t[:-1, :]
+        dX_t = dX_t[:-1, :]
+    return X_t, U_t, dX_t, tplus1
 
-    for i, f in enumerate(files):
 
-        if f[:3] != '.DS':
-            X_t, U_t, dX_t = load_iono_txt(dir + f, load_params)
+def preprocess_iono(dir, load_params):
+    '''
+    Takes in a directory and returns a dataframe for the data, specifically for ionocraft data
+    '''
 
-            # shortens length by one point
-            if load_params.include_tplus1:
-                if X == []:
-                    tplus1 = X_t[1:, :]
-                else:
-                    tplus1 = np.append(tplus1, X_t[1:, :], axis=0)
+    load_log = dict()
 
-                X_t = X_t[:-1, :]
-                U_t = U_t[:-1, :]
-                dX_t = dX_t[:-1, :]
+    files = iono_files(dir, load_params)
 
-            # State data
-            if X == []:
-                X = X_t
-            else:
-                X = np.append(X, X_t, axis=0)
+    load_log['dir'] = load_params.fname
+    load_log['num_files'] = len(files)
 
-            # inputs
-            if U == []:
-                U = U_t
-            else:
-                U = np.append(U, U_t, axis=0)
+    # parsed file by file (in load_params.workers processes if set), concatenated once
+    flights = map_files(_load_iono_flight, [(f, load_params) for f in files], load_params.get('workers', 0))
 
-            # change in state
-            if dX == []:
-                dX = dX_t
-            else:
-                dX = np.append(dX, dX_t, axis=0)
+    X = np.concatenate([fl[0] for fl in flights], axis=0)
+    U = np.concatenate([fl[1] for fl in flights], axis=0)
+    dX = np.concatenate([fl[2] for fl in flights], axis=0)
+    if load_params.include_tplus1:
+        tplus1 = np.concatenate([fl[3] for fl in flights], axis=0)
 
     load_log['datapoints'] = np.shape(X)[0]
 
@@ -723,9 +709,6 @@ def preprocess_iono(dir, load_params):
 
     stack_states = load_params.stack_states
     if stack_states > 0:
-        state_idxs = np.arange(0, 9 * stack_states, 9)
-        input_idxs = np.arange(0, 4 * stack_states, 4)
-
         d = {'omegax'+'_0tx': X[:, 3],
              'omegay'+'_0tx': X[:, 4],
              'omegaz'+'_0tx': X[:, 5],
@@ -752,28 +735,9 @@ def preprocess_iono(dir, load_params):
              'linyz_0dx': dX[:, 2]
              }
 
-        k = 1
-        for i in state_idxs:
-            st = str(k)
-            d['omegax_' + st + 'tx'] = X[:, 3 + i]
-            d['omegay_' + st + 'tx'] = X[:, 4 + i]
-            d['omegaz_' + st + 'tx'] = X[:, 5 + i]
-            d['pitch_' + st + 'tx'] = X[:, 6 + i]
-            d['roll_' + st + 'tx'] = X[:, 7 + i]
-            d['yaw_' + st + 'tx'] = X[:, 8 + i]
-            d['linax_' + st + 'tx'] = X[:, 0 + i]
-            d['linay_' + st + 'tx'] = X[:, 1 + i]
-            d['linaz_' + st + 'tx'] = X[:, 2 + i]
-            k += 1
-
-        k = 1
-        for j in input_idxs:
-            st = str(k)
-            k += 1
-            d['m1pwm_' + st+'tu'] = U[:, 0 + j]
-            d['m2pwm_' + st+'tu'] = U[:, 1 + j]
-            d['m3pwm_' + st+'tu'] = U[:, 2 + j]
-            d['m4pwm_' + st+'tu'] = U[:, 3 + j]
+        # the ionocraft logs the linear accelerations first
+        d.update(history_columns(X, HISTORY_STATES, [3, 4, 5, 6, 7, 8, 0, 1, 2], stack_states, 'tx'))
+        d.update(history_columns(U, HISTORY_INPUTS, range(4), stack_states, 'tu'))
 
     else:  # standard
         d = {'omegax'+'_0tx': X[:, 3],
@@ -999,16 +963,10 @@ def load_iono_txt(fname, load_params):
         ###########################################################################
         # adding to make the input horizontally stacked set of inputs, rather than only the last input because of spinup time
         if input_stack > 1:
-            n, du = np.shape(new_data[:, 0:4])
             _, dx = np.shape(new_data[:, 4:])
 
-            U = np.zeros((n - input_stack + 1, du * input_stack))
-            X = np.zeros((n - input_stack + 1, dx * input_stack))
-            for i in range(input_stack, n + 1, 1):
-                U[i - input_stack,
-                :] = np.flip(new_data[i - input_stack:i, 0:4], axis=0).reshape(1, -1)
-                X[i - input_stack,
-                :] = np.flip(new_data[i - input_stack:i, 4:], axis=0).reshape(1, -1)
+            U = stack_history(new_data[:, 0:4], input_stack)
+            X = stack_history(new_data[:, 4:], input_stack)
 
             if delta_state:
                 # Starts after the data that has requesit U values
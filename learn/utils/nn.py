@@ -78,6 +78,49 @@ class ModelDataHandler:
         return dX
 
 
+class Normalizer(nn.Module):
+    """
+    The fitted X, U and dX scalers of a model as one torch module, so normalization is a single affine op on the
+    batch. Every scaler is written as norm = x * scale + shift (StandardScaler and MinMaxScaler both are), the
+    state and input statistics are concatenated so the network input is normalized in one go.
+    """
+
+    def __init__(self, dx, du, dt):
+        super(Normalizer, self).__init__()
+        # starts out as the identity until fit with set_scalers
+        self.register_buffer('in_scale', torch.ones(dx + du))
+        self.register_buffer('in_shift', torch.zeros(dx + du))
+        self.register_buffer('out_scale', torch.ones(dt))
+        self.register_buffer('out_shift', torch.zeros(dt))
+
+    @staticmethod
+    def affine(scaler):
+        # a fitted StandardScaler or MinMaxScaler as norm = x * a + b
+        if isinstance(scaler, StandardScaler):
+            return 1 / scaler.scale_, -scaler.mean_ / scaler.scale_
+        return scaler.scale_, scaler.min_
+
+    def set_scalers(self, scalarX, scalarU, scalardX):
+        (aX, bX), (aU, bU), (adX, bdX) = [self.affine(sc) for sc in (scalarX, scalarU, scalardX)]
+        # copies into the existing buffers so they stay on the device the model was moved to
+        self.in_scale.copy_(torch.as_tensor(np.concatenate((aX, aU))))
+        self.in_shift.copy_(torch.as_tensor(np.concatenate((bX, bU))))
+        self.out_scale.copy_(torch.as_tensor(adX))
+        self.out_shift.copy_(torch.as_tensor(bdX))
+        return self
+
+    def forward(self, X, U):
+        # raw states and inputs to the normalized network input
+        return torch.cat((X, U), -1) * self.in_scale + self.in_shift
+
+    def normalize_output(self, dX):
+        return dX * self.out_scale + self.out_shift
+
+    def denormalize(self, out):
+        # network output back to the change in state
+        return (out - self.out_shift) / self.out_scale
+
+
 class Swish(nn.Module):
     def __init__(self, B=1.0):
         super(Swish, self).__init__()
@@ -4,6 +4,7 @@ from .nn import *
 from torch.utils.data import Dataset, DataLoader
 
 # data packages
+import os
 import pickle
 import random
 
@@ -123,6 +124,68 @@ def rollout(env, controller, exp_cfg, metric=None):
     return states, actions, rews, sim_error
 
 
+def _seeded_rollout(args):
+    """
+    One episode of rollout_batch: seeds every random number generator the env and controller may use, resets the
+    controller, then runs rollout on the copies of the env and controller it was given
+    """
+    env, controller, exp_cfg, metric, seed, threads = args
+    if threads:
+        torch.set_num_threads(threads)
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+    base = getattr(env, 'unwrapped', env)
+    if hasattr(base, 'seed'):
+        base.seed(seed)
+    if hasattr(getattr(env, 'action_space', None), 'seed'):
+        env.action_space.seed(seed)
+    # every episode starts without a stored plan or controller state, whatever the controller was handed over with
+    controller.reset()
+    return rollout(env, controller, exp_cfg, metric=metric)
+
+
+def rollout_batch(env, controller, exp_cfg, n, metric=None, seed=0, workers=0, threads=0):
+    """
+    Runs n episodes of rollout, each on its own copy of env and controller seeded with seed + i, so the results
+    only depend on the seed and not on how the episodes are spread over processes.
+    With workers > 0 the episodes run in a pool of that many processes, each with threads intra-op threads (default
+    an even share of the cores), env and controller must then pickle.
+    Returns the episodes stacked and zero padded to the longest one:
+     - states [n x T x dx], actions [n x T x du], rewards [n x T]
+     - lengths [n] steps of each episode, sim_errors [n] whether it was stopped for a non physical step
+    """
+    jobs = [(env, controller, exp_cfg, metric, seed + i) for i in range(n)]
+    if workers > 0:
+        threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        with torch.multiprocessing.get_context('spawn').Pool(workers) as pool:
+            results = pool.map(_seeded_rollout, [job + (threads,) for job in jobs])
+    else:
+        # the same copies the processes would get, so state does not carry over between episodes
+        results = [_seeded_rollout(copy.deepcopy(job[:2]) + job[2:] + (0,)) for job in jobs]
+
+    lengths = np.array([len(r[2]) for r in results])
+    T = max(lengths) if n > 0 else 0
+    dx = np.shape(results[0][0])[-1] if n > 0 else 0
+    du = np.shape(results[0][1])[-1] if n > 0 else 0
+    states, actions, rewards = np.zeros((n, T, dx)), np.zeros((n, T, du)), np.zeros((n, T))
+    for i, (st, ac, rew, _) in enumerate(results):
+        states[i, :lengths[i]] = st
+        actions[i, :lengths[i]] = ac
+        rewards[i, :lengths[i]] = np.reshape(rew, -1)
+    sim_errors = np.array([bool(r[3]) for r in results])
+    return states, actions, rewards, lengths, sim_errors
+
+
+def episodes(batch):
+    """
+    Splits the output of rollout_batch back into a list of (states, actions, rews, sim_error) like rollout returns
+    """
+    states, actions, rewards, lengths, sim_errors = batch
+    return [(list(states[i, :l]), list(actions[i, :l]), list(rewards[i, :l]), sim_errors[i])
+            for i, l in enumerate(lengths)]
+
+
 def explorepwm_equil(df):
     """
     Function that takes in a dataset and a model and will look through the distributions of PWM actions
@@ -271,10 +334,8 @@ def gather_predictions(model_dir, dataset, delta=True, variances=False):
     """
     print(f"Gathering one step predictions for dataset of l {len(dataset[0])}")
     if type(model_dir) == str:
-        nn = torch.load(model_dir)
-
-        with open(model_dir[:-4] + '--normparams.pkl', 'rb') as pickle_file:
-            normX1, normU1, normdX1 = pickle.load(pickle_file)
+        from learn.models.checkpoint import load_model
+        nn = load_model(model_dir)
     else:
         nn = model_dir
 
@@ -0,0 +1,154 @@
+"""
+Out of core training data for GeneralNN / EnsembleNN, for flight corpora that don't fit in memory. A MemmapDataset
+reads the state, input and target columns of a columnar dataset (see learn.utils.columnar) through memory maps:
+ - the scalers are fit in one streaming pass with partial_fit, a chunk of rows at a time
+ - minibatches are served chunk-shuffled: the chunks are visited in a random order and the rows are shuffled within
+   each chunk, so every read from disk is one contiguous range per column
+ - a thread reads and normalizes the next batches while the current one trains
+Only a few chunks are ever in memory. Pass a MemmapDataset in place of the (X, U, dX) arrays to train_cust.
+"""
+import math
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+from sklearn.preprocessing import StandardScaler
+
+from .columnar import read_meta
+
+
+class MemmapDataset:
+    def __init__(self, path, state_list, input_list, target_list, rows=None, chunk=65536, prefetch=2):
+        self.path = path
+        self.lists = (list(state_list), list(input_list), list(target_list))
+        self.chunk = chunk
+        self.prefetch = prefetch
+        self._columns = None
+        n = read_meta(path)['rows']
+        self.rows = np.arange(n) if rows is None else np.asarray(rows)
+
+    def __getstate__(self):
+        # pickles as the path and rows (eg. to the ensemble training pool), the memmaps are opened again there
+        state = dict(self.__dict__)
+        state['_columns'] = None
+        return state
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            meta = read_meta(self.path)
+            index = {c: i for i, c in enumerate(meta['columns'])}
+            self._columns = {c: np.load(os.path.join(self.path, f"{index[c]}.npy"), mmap_mode='r')
+                             for lst in self.lists for c in lst}
+        return self._columns
+
+    def subset(self, idx):
+        # the dataset of the rows idx (positions in this dataset)
+        return MemmapDataset(self.path, *self.lists, rows=self.rows[idx], chunk=self.chunk, prefetch=self.prefetch)
+
+    def split(self, frac):
+        # first frac of the rows and the rest, like the train / test split of GeneralNN._optimize
+        n = int(frac * len(self))
+        return self.subset(slice(0, n)), self.subset(slice(n, None))
+
+    def read(self, rows, parts=(0, 1, 2)):
+        """
+        [X, U, dX] (the parts asked for) of the sorted dataset rows as float32 arrays, read as one contiguous
+        range per column
+        """
+        lo, hi = rows[0], rows[-1] + 1
+        sel = None if hi - lo == len(rows) else rows - lo
+        out = []
+        for p in parts:
+            cols = self.lists[p]
+            a = np.empty((len(rows), len(cols)), dtype=np.float32)
+            for j, c in enumerate(cols):
+                col = self.columns[c][lo:hi]
+                a[:, j] = col if sel is None else col[sel]
+            out.append(a)
+        return out
+
+    def n_chunks(self):
+        return math.ceil(len(self) / self.chunk)
+
+    def chunks(self, parts=(0, 1, 2)):
+        for c in range(self.n_chunks()):
+            yield self.read(self.rows[c * self.chunk:(c + 1) * self.chunk], parts)
+
+    def fit_scalers(self, scalarX, scalarU, scalardX):
+        """
+        Fits the scalers on all of the rows in one pass, the first chunk resets them with fit
+        """
+        for i, data in enumerate(self.chunks()):
+            for sc, d in zip((scalarX, scalarU, scalardX), data):
+                sc.fit(d) if i == 0 else sc.partial_fit(d)
+        return scalarX, scalarU, scalardX
+
+    def target_std(self):
+        # standard deviation of the targets in a pass over the target columns only
+        sc = StandardScaler()
+        for dX, in self.chunks(parts=(2,)):
+            sc.partial_fit(dX)
+        return sc.scale_
+
+    def batches(self, batch, transform=None, shuffle=True):
+        """
+        Yields transform(X, U, dX) of minibatches of batch rows (the raw arrays without transform), chunk-shuffled
+        with shuffle and in order otherwise. Batches run across chunks, only the last one can be short. The shuffling
+        is seeded from the torch generator, so torch.manual_seed fixes it.
+        """
+        n_chunks = self.n_chunks()
+        order = torch.randperm(n_chunks).numpy() if shuffle else np.arange(n_chunks)
+        gen = torch.Generator().manual_seed(int(torch.randint(0, 2 ** 62, (1,)))) if shuffle else None
+        transform = transform or (lambda *data: data)
+        q = queue.Queue(max(self.prefetch, 1))
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def work():
+            try:
+                carry = None
+                for c in order:
+                    data = self.read(self.rows[c * self.chunk:(c + 1) * self.chunk])
+                    if shuffle:
+                        p = torch.randperm(len(data[0]), generator=gen).numpy()
+                        data = [d[p] for d in data]
+                    if carry is not None:
+                        data = [np.concatenate((a, b)) for a, b in zip(carry, data)]
+                    n = len(data[0]) // batch * batch
+                    for i in range(0, n, batch):
+                        if not put(transform(*[d[i:i + batch] for d in data])):
+                            return
+                    carry = [d[n:] for d in data]
+                if carry is not None and len(carry[0]) > 0:
+                    put(transform(*carry))
+            except BaseException as e:
+                put(e)
+            put(None)
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,27 @@
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from learn.control.mpc import MPController
+from learn.envs.crazyflie_rigid import CrazyflieRigidEnv
+from learn.models.rigid_model import RigidBodyModel
+
+
+def cem_controller(env, elites, N=20):
+    params = dict(mode='random', N=N, T=3, hold=False, iterations=2, elites=elites, alpha=.1)
+    cfg = OmegaConf.create(dict(policy=dict(mode='cem', params=dict(period=1)), cem=dict(params=params)))
+    return MPController(env, RigidBodyModel.from_env(env), cfg)
+
+
+@pytest.mark.parametrize('elites', [1, 21])
+def test_cem_rejects_elites_out_of_bounds(elites):
+    with pytest.raises(ValueError, match='elites'):
+        cem_controller(CrazyflieRigidEnv(), elites)
+
+
+@pytest.mark.parametrize('elites', [2, 20])
+def test_cem_plans_at_elites_bounds(elites):
+    env = CrazyflieRigidEnv()
+    ctrl = cem_controller(env, elites)
+    action = ctrl.get_action(env.reset())
+    assert torch.isfinite(action).all()
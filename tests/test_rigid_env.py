@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from learn.envs.crazyflie_rigid import CrazyflieRigidEnv
+from learn.envs.ionocraft_rigid import IonocraftRigidEnv
+from learn.envs.rigidbody import VecRigidEnv
+
+
+@pytest.mark.parametrize('cls', [CrazyflieRigidEnv, IonocraftRigidEnv])
+def test_inv_huber_reward_batch(cls):
+    env = cls()
+    env.inv_huber = True
+    obs = np.zeros((4, 9))
+    # pitch / roll above and below the switch of the inverse huber (5 after dividing by 180)
+    obs[:, 0] = [0, 180, 1800, -1800]
+    obs[:, 1] = [90, -1080, 0, 1800]
+    rew = env.get_reward(obs, np.zeros((4, 4)))
+    assert rew.shape == (4,)
+    np.testing.assert_allclose(rew, -np.array([.5, 1 + 36, 100, 100 + 100]))
+    for o, r in zip(obs, rew):
+        assert env.get_reward(o, np.zeros(4)) == pytest.approx(r)
+
+
+def test_vec_env_steps_with_inv_huber():
+    env = CrazyflieRigidEnv()
+    env.inv_huber = True
+    vec = VecRigidEnv(env, 5, seed=0)
+    vec.reset()
+    obs, reward, dones, _ = vec.step(np.full((5, 4), 30000.))
+    assert reward.shape == (5,)
+    assert np.isfinite(reward).all()
+
+
+@pytest.mark.parametrize('integrator', ['euler', 'rk4', 'rk45'])
+def test_rigid_model_matches_env(integrator):
+    from learn.models.rigid_model import RigidBodyModel
+    import torch
+
+    env = CrazyflieRigidEnv(integrator=integrator)
+    env.seed(0)
+    env.reset()
+    model = RigidBodyModel.from_env(env)
+    pwm = np.array([[30000., 32000., 31000., 30500.], [20000., 20000., 40000., 40000.]])
+    x = np.stack([env.state, env.state * 2])
+    expected = env._integrate(x.copy(), env.pwm_thrust_torque(pwm))
+    with torch.no_grad():
+        out = model(torch.as_tensor(x), torch.as_tensor(pwm)).numpy()
+    np.testing.assert_allclose(out, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_reset_clears_rk45_step():
+    env = CrazyflieRigidEnv(integrator='rk45')
+    env.reset()
+    env.step(np.full(4, 30000.))
+    assert env.h is not None
+    env.reset()
+    assert env.h is None
+
+
+@pytest.mark.parametrize('integrator', ['euler', 'rk4', 'rk45'])
+def test_vec_env_steps_once_all_done(integrator):
+    vec = VecRigidEnv(CrazyflieRigidEnv(integrator=integrator), 3, seed=0)
+    vec.reset()
+    # tipped past the done angle, every env is done after the first step
+    state = vec.state.copy()
+    state[:, 7] = np.pi / 2
+    vec.set_state(state)
+    for _ in range(3):
+        obs, reward, dones, _ = vec.step(np.full((3, 4), 30000.))
+    assert dones.all()
+    np.testing.assert_array_equal(reward, 0)
+    assert vec.env._rk45(np.zeros((0, 12)), np.zeros((0, 4))).shape == (0, 12)